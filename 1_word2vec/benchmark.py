@@ -0,0 +1,180 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from queue import Empty
+
+import numpy as np
+
+from skipgram_negative_sampling import Vocabulary, MODELS
+
+"""
+# Word2vec benchmark
+
+Generates deterministic Zipf-distributed corpora of several sizes offline, then times
+load_corpus (vocabulary and tokens), init_unigram_table, one epoch of SkipGram.train and save_embedding
+under fixed seeds. Wall times, pairs/sec and peak RSS are written to a JSON file and, if a baseline JSON
+is given, compared against it. The exit code is 1 when a case failed or a metric regressed by more than
+the tolerance.
+
+$ python benchmark.py --output bench.json
+$ python benchmark.py --baseline bench.json
+"""
+
+# Metrics where a larger value is better; for all others a smaller value is better.
+HIGHER_IS_BETTER = {"pairs_per_sec"}
+
+
+def _word(index):
+    letters = []
+    index += 1
+    while index > 0:
+        index, rest = divmod(index - 1, 26)
+        letters.append(chr(ord('a') + rest))
+    return ''.join(reversed(letters))
+
+
+def generate_corpus(file_name, num_tokens, vocab_size, sentence_length=20, exponent=1.0, seed=2019):
+    """
+    Write num_tokens words drawn from a Zipf distribution over vocab_size distinct words.
+    The same arguments always produce the same file.
+    """
+    random_state = np.random.RandomState(seed)
+    words = np.array([_word(i) for i in range(vocab_size)])
+    cdf = np.cumsum(1. / np.arange(1, vocab_size + 1) ** exponent)
+    tokens = np.searchsorted(cdf, random_state.random_sample(num_tokens) * cdf[-1])
+    with open(file_name, 'w', encoding="utf-8") as fout:
+        for start in range(0, num_tokens, sentence_length):
+            fout.write(' '.join(words[tokens[start:start + sentence_length]]) + '.\n')
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+
+def _run_case(corpus_file_name, output_file_name, args, results):
+    vocab = Vocabulary()
+    model = MODELS[args.model](vocab, args.embedding_dim, dtype=args.dtype)
+    model.enable_profiling()
+    profiler = model.profiler
+
+    start = time.perf_counter()
+    model.train(corpus_file_name, output_file_name, total_epoch=1, learning_rate=0.025, min_count=args.min_count,
+                max_count=10 ** 9, window_size=args.window_size, num_negative=args.num_negative,
+                sample_bound=args.sample_bound, debug=False, train_mode=args.train_mode, callback=None,
+                visualize_top_k=0)
+    total = time.perf_counter() - start
+
+    epoch = profiler.epochs[0]
+    results.put({
+        "load_corpus_s": profiler.totals['load_corpus'],
+        "init_unigram_table_s": profiler.totals['init_output_layer'],
+        "epoch_s": epoch['seconds'],
+        "pairs_per_sec": epoch['pairs'] / max(epoch['seconds'], 1e-12),
+        "save_embedding_s": profiler.totals['save_embedding'],
+        "total_s": total,
+        "peak_rss_mb": _peak_rss_mb(),
+    })
+
+
+def run_benchmark(args):
+    # Every case runs in a fresh interpreter so that peak RSS is measured per corpus size.
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        for num_tokens in args.sizes:
+            corpus_file_name = os.path.join(work_dir, 'zipf_{}.txt'.format(num_tokens))
+            generate_corpus(corpus_file_name, num_tokens, args.vocab_size)
+            result_queue = context.Queue()
+            process = context.Process(target=_run_case, args=(
+                corpus_file_name, os.path.join(work_dir, 'embedding_{}.txt'.format(num_tokens)), args, result_queue))
+            process.start()
+            results[str(num_tokens)] = _wait_for_case(process, result_queue)
+            process.join()
+    return results
+
+
+def _wait_for_case(process, result_queue, poll_seconds=1.):
+    """
+    :return: (dict) : metrics of the case, or {"error": ...} if its process exited without sending them
+    """
+    while True:
+        try:
+            return result_queue.get(timeout=poll_seconds)
+        except Empty:
+            if process.exitcode is not None:
+                # The result may have been sent right before the process exited.
+                try:
+                    return result_queue.get(timeout=poll_seconds)
+                except Empty:
+                    return {"error": "case process exited with code {}".format(process.exitcode)}
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: (List[str]) : one message per metric that is worse than the baseline by more than tolerance
+    """
+    regressions = []
+    for size, metrics in results.items():
+        if "error" in metrics:
+            continue
+        for name, value in metrics.items():
+            base = baseline.get(size, {}).get(name)
+            if value is None or not base:
+                continue
+            change = (value - base) / base
+            if name in HIGHER_IS_BETTER:
+                change = -change
+            if change > tolerance:
+                regressions.append("{} tokens, {}: {:.4g} vs baseline {:.4g} ({:+.1f}%)".format(
+                    size, name, value, base, 100 * change))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Parser for the word2vec benchmark")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[20000, 100000, 500000],
+                        help="Number of tokens of each synthetic corpus")
+    parser.add_argument("--vocab-size", type=int, default=10000)
+    parser.add_argument("--model", type=str, default="skipgram", choices=sorted(MODELS))
+    parser.add_argument("--train-mode", type=str, default="batch", choices=["pair", "batch", "pipeline"])
+    parser.add_argument("--embedding-dim", type=int, default=100)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float64"])
+    parser.add_argument("--min-count", type=int, default=7)
+    parser.add_argument("--window-size", type=int, default=5)
+    parser.add_argument("--num-negative", type=int, default=5)
+    parser.add_argument("--sample-bound", type=float, default=1e-5)
+    parser.add_argument("--output", type=str, default="./benchmark_results.json")
+    parser.add_argument("--baseline", type=str, default=None, help="Results JSON of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression per metric")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    with open(args.output, 'w') as fout:
+        json.dump({"config": vars(args), "results": results}, fout, indent=2)
+    print(json.dumps(results, indent=2))
+    print("Save results at {}".format(args.output))
+
+    failures = {size: metrics["error"] for size, metrics in results.items() if "error" in metrics}
+    for size, error in failures.items():
+        print("FAILED", "{} tokens: {}".format(size, error))
+
+    if args.baseline:
+        with open(args.baseline) as fin:
+            regressions = compare(results, json.load(fin)["results"], args.tolerance)
+        for message in regressions:
+            print("REGRESSION", message)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against {}".format(args.baseline))
+    if failures:
+        sys.exit(1)
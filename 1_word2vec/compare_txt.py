@@ -1,4 +1,12 @@
 import argparse
+import heapq
+import itertools
+import os
+import tempfile
+import zlib
+from collections import defaultdict
+
+import numpy as np
 
 def compare_line_by_line(fname1, fname2):
     # Open file for reading in text mode (default mode)
@@ -58,12 +66,212 @@ def compare_line_by_line(fname1, fname2):
     f1.close()
     f2.close()
 
+
+def _read_rows(fin):
+    """
+    Yield (word, values) string pairs of an embedding text file, skipping the "num_words dim" header
+    and blank lines. The word may be empty: save_embedding writes a row for the '' vocabulary entry.
+    """
+    for line_no, line in enumerate(fin):
+        fields = line.rstrip('\n').rstrip(' ').split(' ')
+        if line_no == 0 and len(fields) == 2 and fields[0].isdigit() and fields[1].isdigit():
+            continue
+        if len(fields) > 1:
+            yield fields[0], fields[1:]
+
+
+def _parse(values):
+    """
+    :param values: (List[List[str]]) : rows of value strings, all of the same length
+    :return: [len(values), embedding_dim] (np.ndarray) : float matrix
+    """
+    return np.array(values, dtype=np.float64)
+
+
+class EmbeddingDiff:
+
+    """
+    Running statistics of the numeric differences between two embeddings.
+    Only counters and the report_top worst rows are kept, so memory does not grow with the vocabulary.
+    """
+
+    def __init__(self, tolerance, cosine_tolerance, report_top=20):
+        self.tolerance = tolerance
+        self.cosine_tolerance = cosine_tolerance
+        self.report_top = report_top
+        self.compared = 0
+        self.differing = 0
+        self.max_abs_sum = 0.
+        self.max_abs_max = 0.
+        self.cosine_sum = 0.
+        self.cosine_max = 0.
+        self.worst = []
+        self.only_in = ([], [])
+        self.only_in_count = [0, 0]
+        self.shape_mismatch = 0
+
+    def update(self, words, embedding1, embedding2):
+        """
+        :param words: (List[str]) : words of the aligned rows
+        :param embedding1: [num_rows, embedding_dim] (np.ndarray)
+        :param embedding2: [num_rows, embedding_dim] (np.ndarray)
+        """
+        if len(words) == 0:
+            return
+        if embedding1.shape != embedding2.shape:
+            self.shape_mismatch += len(words)
+            return
+        max_abs = np.abs(embedding1 - embedding2).max(axis=1)
+        norms = np.linalg.norm(embedding1, axis=1) * np.linalg.norm(embedding2, axis=1)
+        cosine = 1 - np.einsum('ij,ij->i', embedding1, embedding2) / np.maximum(norms, 1e-300)
+        cosine = np.maximum(cosine, 0.)
+        cosine[norms == 0] = 0.
+
+        self.compared += len(words)
+        self.max_abs_sum += max_abs.sum()
+        self.max_abs_max = max(self.max_abs_max, max_abs.max())
+        self.cosine_sum += cosine.sum()
+        self.cosine_max = max(self.cosine_max, cosine.max())
+
+        differing = np.flatnonzero((max_abs > self.tolerance) | (cosine > self.cosine_tolerance))
+        self.differing += len(differing)
+        for i in differing.tolist():
+            item = (max_abs[i], cosine[i], words[i])
+            if len(self.worst) < self.report_top:
+                heapq.heappush(self.worst, item)
+            else:
+                heapq.heappushpop(self.worst, item)
+
+    def update_rows(self, words, values1, values2):
+        """
+        Compare aligned rows of value strings, which need not all have the same length.
+        Rows whose lengths differ between the files are counted in shape_mismatch; the others are
+        compared with update, one group per row length.
+        :param words: (List[str]) : words of the aligned rows
+        :param values1, values2: (List[List[str]])
+        """
+        groups = defaultdict(list)
+        for i, (row1, row2) in enumerate(zip(values1, values2)):
+            if len(row1) == len(row2):
+                groups[len(row1)].append(i)
+            else:
+                self.shape_mismatch += 1
+        for rows in groups.values():
+            self.update([words[i] for i in rows], _parse([values1[i] for i in rows]),
+                        _parse([values2[i] for i in rows]))
+
+    def missing(self, side, words):
+        """
+        Record words that only appear in file1 (side 0) or file2 (side 1).
+        """
+        self.only_in_count[side] += len(words)
+        self.only_in[side].extend(words[:self.report_top - len(self.only_in[side])])
+
+    def report(self):
+        print("Compared rows         : {}".format(self.compared))
+        print("Rows above tolerance  : {} (max-abs > {:g} or cosine distance > {:g})".format(
+            self.differing, self.tolerance, self.cosine_tolerance))
+        if self.compared:
+            print("Max-abs difference    : mean {:.3e}, max {:.3e}".format(
+                self.max_abs_sum / self.compared, self.max_abs_max))
+            print("Cosine distance       : mean {:.3e}, max {:.3e}".format(
+                self.cosine_sum / self.compared, self.cosine_max))
+        if self.shape_mismatch:
+            print("Rows of different dim : {}".format(self.shape_mismatch))
+        for side in (0, 1):
+            if self.only_in_count[side]:
+                print("Only in file{} ({} rows): {}".format(side + 1, self.only_in_count[side],
+                                                        " ".join(self.only_in[side])))
+        for (max_abs, cosine, word) in sorted(self.worst, reverse=True):
+            print("  {:<20} max-abs {:.3e}  cosine {:.3e}".format(word, max_abs, cosine))
+
+    def identical(self):
+        return self.differing == 0 and self.shape_mismatch == 0 and not any(self.only_in_count)
+
+
+def _compare_buckets(rows1, rows2, diff, num_buckets, chunk_size):
+    """
+    Compare rows whose order differs between the files. Both row streams are hash-partitioned by word
+    into num_buckets temporary files, then each pair of buckets is compared in memory, so memory is
+    bounded by the size of one bucket rather than the vocabulary.
+    """
+    with tempfile.TemporaryDirectory() as bucket_dir:
+        for side, rows in enumerate((rows1, rows2)):
+            buckets = [open(os.path.join(bucket_dir, '{}.{}'.format(side, b)), 'w', encoding="utf-8")
+                       for b in range(num_buckets)]
+            for (word, values) in rows:
+                buckets[zlib.crc32(word.encode('utf-8')) % num_buckets].write(word + ' ' + ' '.join(values) + '\n')
+            for bucket in buckets:
+                bucket.close()
+
+        for b in range(num_buckets):
+            bucket_rows = []
+            for side in (0, 1):
+                with open(os.path.join(bucket_dir, '{}.{}'.format(side, b)), encoding="utf-8") as fin:
+                    bucket_rows.append(dict(_read_rows(fin)))
+            common = [word for word in bucket_rows[0] if word in bucket_rows[1]]
+            for start in range(0, len(common), chunk_size):
+                words = common[start:start + chunk_size]
+                diff.update_rows(words, [bucket_rows[0][w] for w in words], [bucket_rows[1][w] for w in words])
+            for side in (0, 1):
+                other = bucket_rows[1 - side]
+                diff.missing(side, [word for word in bucket_rows[side] if word not in other])
+
+
+def compare_embeddings(fname1, fname2, tolerance=1e-5, cosine_tolerance=1e-6, chunk_size=10000,
+                       num_buckets=64, report_top=20):
+    """
+    Numerically compare two text embeddings written by SkipGram.save_embedding.
+    Both files are streamed chunk_size rows at a time. While the words of both chunks line up the rows are
+    compared directly; from the first chunk where they do not, the rest of both files is compared by word
+    through hash-partitioned buckets (see _compare_buckets).
+    :param tolerance: (float) : a row differs if any coordinate differs by more than this
+    :param cosine_tolerance: (float) : a row also differs if its cosine distance exceeds this
+    :return: (EmbeddingDiff) : the statistics, already printed
+    """
+    diff = EmbeddingDiff(tolerance, cosine_tolerance, report_top)
+
+    print("-----------------------------------")
+    print("Comparing embeddings ", " > " + fname1, " < " + fname2, sep='\n')
+    print("-----------------------------------")
+
+    with open(fname1, encoding="utf-8") as f1, open(fname2, encoding="utf-8") as f2:
+        rows1, rows2 = _read_rows(f1), _read_rows(f2)
+        while True:
+            chunk1 = list(itertools.islice(rows1, chunk_size))
+            chunk2 = list(itertools.islice(rows2, chunk_size))
+            if not chunk1 and not chunk2:
+                break
+            if [word for (word, _) in chunk1] != [word for (word, _) in chunk2]:
+                _compare_buckets(itertools.chain(chunk1, rows1), itertools.chain(chunk2, rows2),
+                                 diff, num_buckets, chunk_size)
+                break
+            diff.update_rows([word for (word, _) in chunk1], [values for (_, values) in chunk1],
+                             [values for (_, values) in chunk2])
+
+    diff.report()
+    return diff
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Parser for comparing two text files")
     parser.add_argument("--file1-name", type=str, default="./file1.txt")
     parser.add_argument("--file2-name", type=str, default="./file2.txt")
-    args = parser.parse_args(args=[])
+    parser.add_argument("--mode", type=str, default="line", choices=["line", "numeric"],
+                        help="line: print every differing line, numeric: compare text embeddings within a tolerance")
+    parser.add_argument("--tolerance", type=float, default=1e-5, help="Allowed max-abs difference per row")
+    parser.add_argument("--cosine-tolerance", type=float, default=1e-6, help="Allowed cosine distance per row")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="Rows read from each file at a time")
+    parser.add_argument("--num-buckets", type=int, default=64,
+                        help="Hash partitions used when the rows of the two files are in a different order")
+    parser.add_argument("--report-top", type=int, default=20, help="Number of worst rows to list")
+    args = parser.parse_args()
 
-    compare_line_by_line(args.file1_name, args.file2_name)
+    if args.mode == "numeric":
+        diff = compare_embeddings(args.file1_name, args.file2_name, args.tolerance, args.cosine_tolerance,
+                                  args.chunk_size, args.num_buckets, args.report_top)
+        if diff.identical():
+            print("Embeddings match within tolerance")
+    else:
+        compare_line_by_line(args.file1_name, args.file2_name)
 
     print("Complete!")
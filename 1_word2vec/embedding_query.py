@@ -0,0 +1,98 @@
+import argparse
+
+import numpy as np
+
+from skipgram_negative_sampling import load_embedding
+
+
+class EmbeddingIndex:
+
+    """
+    Cosine-similarity nearest-neighbour queries over trained embeddings.
+    The embedding is L2-normalized once into a contiguous float32 matrix, so a batch of queries
+    costs a single matrix multiply plus an argpartition per row.
+    """
+
+    def __init__(self, word2index, embedding):
+        """
+        :param word2index: (Dict[str, int]) : row of each word, e.g. Vocabulary.word2index
+        :param embedding: [vocab_dim, embedding_dim] (np.ndarray) : W matrix
+        """
+        self.word2index = word2index
+        self.index2word = {w_id: word for (word, w_id) in word2index.items()}
+        embedding = np.asarray(embedding, dtype=np.float32)
+        norms = np.linalg.norm(embedding, axis=1, keepdims=True)
+        self.normalized = np.ascontiguousarray(embedding / np.maximum(norms, 1e-12))
+
+    @classmethod
+    def from_skipgram(cls, skip_gram):
+        return cls(skip_gram.vocab.word2index, skip_gram.W)
+
+    @classmethod
+    def from_file(cls, file_name, output_format="text"):
+        words, embedding = load_embedding(file_name, output_format)
+        return cls({word: w_id for (w_id, word) in enumerate(words)}, embedding)
+
+    def lookup(self, words):
+        """
+        :param words: (List[str])
+        :return: [len(words)] (np.ndarray) : row indices; raises KeyError for unknown words
+        """
+        return np.array([self.word2index[word] for word in words], dtype=np.int64)
+
+    def most_similar_vectors(self, vectors, top_k=10, exclude=None, batch_size=1024):
+        """
+        :param vectors: [num_queries, embedding_dim] (np.ndarray) : query vectors, need not be normalized
+        :param top_k: (int) : number of neighbours per query
+        :param exclude: [num_queries] or [num_queries, k] (np.ndarray) : row indices to leave out of each
+            query's result, or None
+        :param batch_size: (int) : number of queries per matrix multiply, bounding memory to batch_size x vocab_dim
+        :return: ([num_queries, top_k] (np.ndarray), [num_queries, top_k] (np.ndarray)) : row indices and
+            cosine similarities, most similar first
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        if exclude is not None:
+            exclude = np.asarray(exclude)
+            if exclude.ndim == 1:
+                exclude = exclude[:, None]
+        top_k = min(top_k, len(self.normalized) - (0 if exclude is None else exclude.shape[1]))
+        indices = np.empty((len(vectors), top_k), dtype=np.int64)
+        scores = np.empty((len(vectors), top_k), dtype=np.float32)
+        for start in range(0, len(vectors), batch_size):
+            end = start + batch_size
+            similarity = vectors[start:end].dot(self.normalized.T)
+            rows = np.arange(len(similarity))[:, None]
+            if exclude is not None:
+                similarity[rows, exclude[start:end]] = -np.inf
+            if top_k == 1:
+                candidates = similarity.argmax(axis=1)[:, None]
+            else:
+                candidates = np.argpartition(-similarity, top_k - 1, axis=1)[:, :top_k]
+            order = np.argsort(-similarity[rows, candidates], axis=1)
+            indices[start:end] = candidates[rows, order]
+            scores[start:end] = similarity[rows, indices[start:end]]
+        return indices, scores
+
+    def most_similar(self, words, top_k=10, batch_size=1024):
+        """
+        :param words: (List[str]) : query words
+        :return: (List[List[(str, float)]]) : the top_k most similar words of each query, excluding itself
+        """
+        query = self.lookup(words)
+        indices, scores = self.most_similar_vectors(self.normalized[query], top_k, query, batch_size)
+        return [[(self.index2word[w_id], score) for (w_id, score) in zip(row_ids.tolist(), row_scores.tolist())]
+                for (row_ids, row_scores) in zip(indices, scores)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Parser for nearest-neighbour queries over embeddings")
+    parser.add_argument("words", type=str, nargs='+')
+    parser.add_argument("--file-name", type=str, default="./embedding_results.txt")
+    parser.add_argument("--output-format", type=str, default="text", choices=["text", "binary", "npy"])
+    parser.add_argument("--top-k", type=int, default=10)
+    args = parser.parse_args()
+
+    index = EmbeddingIndex.from_file(args.file_name, args.output_format)
+    for word, neighbours in zip(args.words, index.most_similar(args.words, args.top_k)):
+        print("{}: {}".format(word, ", ".join("{} ({:.3f})".format(w, s) for (w, s) in neighbours)))
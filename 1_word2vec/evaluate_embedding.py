@@ -0,0 +1,149 @@
+import argparse
+import time
+
+import numpy as np
+
+from embedding_query import EmbeddingIndex
+
+"""
+# Embedding evaluation
+
+Scores embeddings written by SkipGram.save_embedding on local benchmark files:
+- analogy files in the format of word2vec's questions-words.txt (": section" lines followed by
+  "a b c d" questions), answered with 3CosAdd (the nearest word to b - a + c other than a, b and c)
+- similarity files with one "word1 word2 score" line per pair (WordSim353, SimLex-999, MEN, ...),
+  scored by the Spearman correlation of the scores with the cosine similarities
+
+$ python evaluate_embedding.py --analogy questions-words.txt --similarity wordsim353.tsv
+"""
+
+
+def rankdata(values):
+    """
+    :param values: [n] (np.ndarray)
+    :return: [n] (np.ndarray) : 1-based ranks, ties get the average of their ranks
+    """
+    _, inverse, counts = np.unique(values, return_inverse=True, return_counts=True)
+    # The tied values of group g take the ranks after all smaller groups.
+    ends = np.cumsum(counts)
+    return (ends - (counts - 1) / 2.)[inverse]
+
+
+def spearman(x, y):
+    """
+    :return: (float) : Spearman's rank correlation of x and y, nan for fewer than two points
+    """
+    if len(x) < 2:
+        return np.nan
+    return float(np.corrcoef(rankdata(x), rankdata(y))[0, 1])
+
+
+def read_analogies(file_name):
+    """
+    :return: (List[str], List[List[str]]) : the section of every question and the questions as 4 words
+    """
+    sections, questions = [], []
+    section = ''
+    with open(file_name, 'r', encoding="utf-8") as fin:
+        for line in fin:
+            if line.startswith(':'):
+                section = line[1:].strip()
+                continue
+            words = line.lower().split()
+            if len(words) == 4:
+                sections.append(section)
+                questions.append(words)
+    return sections, questions
+
+
+def read_similarities(file_name):
+    """
+    Lines whose third field is not a number (headers, comments) are skipped.
+    :return: (List[(str, str)], np.ndarray) : word pairs and their scores
+    """
+    pairs, scores = [], []
+    with open(file_name, 'r', encoding="utf-8") as fin:
+        for line in fin:
+            fields = line.lower().replace(',', ' ').split()
+            if len(fields) < 3:
+                continue
+            try:
+                score = float(fields[2])
+            except ValueError:
+                continue
+            pairs.append((fields[0], fields[1]))
+            scores.append(score)
+    return pairs, np.array(scores)
+
+
+def _known(index, rows):
+    """
+    :return: (np.ndarray, np.ndarray) : boolean mask of the rows whose words are all in the vocabulary,
+        and the [num_known, len(row)] row indices of those words
+    """
+    known = np.array([all(word in index.word2index for word in row) for row in rows], dtype=bool)
+    ids = np.array([[index.word2index[word] for word in row] for (row, ok) in zip(rows, known) if ok],
+                   dtype=np.int64).reshape(-1, len(rows[0]) if rows else 0)
+    return known, ids
+
+
+def evaluate_analogies(index, sections, questions, batch_size=1024):
+    """
+    :param index: (EmbeddingIndex)
+    :return: (dict) : number of questions, covered questions, overall accuracy over the covered ones,
+        and per section (covered, correct)
+    """
+    if not questions:
+        return {'questions': 0, 'covered': 0, 'accuracy': np.nan, 'sections': {}}
+    known, ids = _known(index, questions)
+    vectors = index.normalized
+    queries = vectors[ids[:, 1]] - vectors[ids[:, 0]] + vectors[ids[:, 2]]
+    predictions, _ = index.most_similar_vectors(queries, 1, ids[:, :3], batch_size)
+    correct = predictions[:, 0] == ids[:, 3]
+
+    known_sections = np.array(sections, dtype=object)[known]
+    per_section = {}
+    for section in dict.fromkeys(sections):
+        in_section = known_sections == section
+        per_section[section] = (int(in_section.sum()), int(correct[in_section].sum()))
+    return {'questions': len(questions), 'covered': int(known.sum()),
+            'accuracy': float(correct.mean()) if len(correct) else np.nan, 'sections': per_section}
+
+
+def evaluate_similarities(index, pairs, scores):
+    """
+    :param index: (EmbeddingIndex)
+    :return: (dict) : number of pairs, covered pairs and the Spearman correlation over the covered ones
+    """
+    if not pairs:
+        return {'pairs': 0, 'covered': 0, 'spearman': np.nan}
+    known, ids = _known(index, pairs)
+    cosine = np.einsum('ij,ij->i', index.normalized[ids[:, 0]], index.normalized[ids[:, 1]])
+    return {'pairs': len(pairs), 'covered': int(known.sum()), 'spearman': spearman(scores[known], cosine)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Parser for evaluating embeddings on analogy and similarity files")
+    parser.add_argument("--file-name", type=str, default="./embedding_results.txt")
+    parser.add_argument("--output-format", type=str, default="text", choices=["text", "binary", "npy"])
+    parser.add_argument("--analogy", type=str, nargs='*', default=[], help="Analogy files (questions-words.txt format)")
+    parser.add_argument("--similarity", type=str, nargs='*', default=[],
+                        help="Similarity files with one 'word1 word2 score' line per pair")
+    parser.add_argument("--batch-size", type=int, default=1024, help="Number of analogy questions per matrix multiply")
+    parser.add_argument("--show-sections", action="store_true", help="Also print the accuracy of every analogy section")
+    args = parser.parse_args()
+
+    index = EmbeddingIndex.from_file(args.file_name, args.output_format)
+    for file_name in args.analogy:
+        start = time.time()
+        result = evaluate_analogies(index, *read_analogies(file_name), batch_size=args.batch_size)
+        print("{}: accuracy {:.4f} on {} / {} questions ({:.2f}s)".format(
+            file_name, result['accuracy'], result['covered'], result['questions'], time.time() - start))
+        if args.show_sections:
+            for section, (covered, correct) in result['sections'].items():
+                print("  {:<30} {:.4f} on {} questions".format(section, correct / covered if covered else np.nan, covered))
+    for file_name in args.similarity:
+        start = time.time()
+        result = evaluate_similarities(index, *read_similarities(file_name))
+        print("{}: spearman {:.4f} on {} / {} pairs ({:.2f}s)".format(
+            file_name, result['spearman'], result['covered'], result['pairs'], time.time() - start))
@@ -1,13 +1,24 @@
 import argparse
+import glob
+import hashlib
 import re
 
 import numpy as np
-import queue
 import pdb
 import os
 from tqdm import trange, tqdm
 import sys
-from copy import deepcopy
+import time
+import traceback
+import contextlib
+import functools
+import json
+import heapq
+import multiprocessing
+import queue
+import threading
+from collections import Counter, defaultdict
+from collections.abc import Mapping
 
 
 def _download_dataset(file_path):
@@ -41,114 +52,955 @@ def sigmoid(x, derivative=False):
     return sigm
 
 
+def logistic_loss(gradients, bound=6):
+    """
+    Binary logistic loss (of negative sampling or hierarchical softmax) recovered from the gradient
+    scalars of backward, label - sigmoid(forwards):
+    each term is -log(1 - |gradient|), capped at -log(sigmoid(-bound)) where backward saturates.
+    :param gradients: (np.ndarray or List[float])
+    :return: (float) : summed loss
+    """
+    return float(-np.log(np.maximum(1. - np.abs(gradients), sigmoid(-bound))).sum())
+
+
+def scatter_updates(matrix, rows, updates):
+    """
+    Add updates to the rows of matrix in place, dividing the summed updates of a row by the square root
+    of its number of occurrences. Plain sums (np.add.at) take one full step per occurrence from the same
+    stale weights, which overshoots for frequent words and diverges for large batches; a plain mean
+    keeps only one step per batch and under-trains them.
+    :param matrix: [num_rows, dim] (np.ndarray)
+    :param rows: [n] (np.ndarray) : row index of every update
+    :param updates: [n, dim] (np.ndarray)
+    """
+    if len(rows) == 0:
+        return
+    order = np.argsort(rows, kind='stable')
+    rows = rows[order]
+    starts = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+    counts = np.diff(np.append(starts, len(rows)))
+    summed = np.add.reduceat(updates[order], starts, axis=0)
+    matrix[rows[starts]] += summed / np.sqrt(counts[:, None]).astype(matrix.dtype)
+
+
+def _hogwild_worker(skip_gram, shm_names, worker_id, corpus, seed, num_pairs, losses, *epoch_args):
+    from multiprocessing import shared_memory
+    np.random.seed(seed)
+    shms = [shared_memory.SharedMemory(name=name) for name in shm_names]
+    try:
+        skip_gram.corpus = corpus
+        skip_gram.W, skip_gram.W_prime = [
+            np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=shm.buf)
+            for matrix, shm in zip((skip_gram.W, skip_gram.W_prime), shms)]
+        num_pairs[worker_id], losses[worker_id] = skip_gram.train_epoch(*epoch_args)
+    finally:
+        skip_gram.W = skip_gram.W_prime = None
+        for shm in shms:
+            shm.close()
+
+
+def _pipeline_producer(skip_gram, producer_id, corpus, seed, batch_queue, stop, *batch_args):
+    if seed is not None:
+        np.random.seed(seed)
+    stall = 0.
+    error = None
+    try:
+        for batch in skip_gram.batches(corpus, *batch_args):
+            if stop.is_set():
+                break
+            wait_start = time.perf_counter()
+            batch_queue.put(('batch', batch))
+            stall += time.perf_counter() - wait_start
+    except Exception:
+        error = traceback.format_exc()
+    batch_queue.put(('done', producer_id, stall, error))
+
+
+def _receive(batch_queue, workers, finished, poll_seconds=1.):
+    """
+    Wait for the next message of the pipeline producers.
+    A producer that is found dead on two polls in a row without having sent its 'done' message
+    (killed, or exited before reaching it) is reported as finished with an error.
+    :param workers: (List[threading.Thread or multiprocessing.Process]) : the producers
+    :param finished: (Set[int]) : ids of the producers whose 'done' message was already received
+    :return: (tuple) : ('batch', (progress, batch)) or ('done', producer_id, stall, error)
+    """
+    dead_before = set()
+    while True:
+        try:
+            return batch_queue.get(timeout=poll_seconds)
+        except queue.Empty:
+            dead = {i for (i, worker) in enumerate(workers) if i not in finished and not worker.is_alive()}
+            lost = dead & dead_before
+            if lost:
+                producer_id = min(lost)
+                return ('done', producer_id, 0., "producer {} exited with code {} before finishing".format(
+                    producer_id, getattr(workers[producer_id], 'exitcode', None)))
+            dead_before = dead
+
+
+def is_sharded(input_file_name):
+    """
+    :return: (bool) : whether input_file_name names a directory or a glob pattern of corpus shards
+    """
+    return os.path.isdir(input_file_name) or any(c in input_file_name for c in '*?[')
+
+
+def input_files(input_file_name):
+    """
+    :param input_file_name: (str) : a corpus file, a directory of shard files or a glob pattern
+    :return: (List[str]) : sorted file names; hidden files of a directory are skipped
+    """
+    if os.path.isdir(input_file_name):
+        file_names = [os.path.join(input_file_name, name) for name in os.listdir(input_file_name)
+                      if not name.startswith('.')]
+        file_names = [name for name in file_names if os.path.isfile(name)]
+    elif is_sharded(input_file_name):
+        file_names = [name for name in glob.glob(input_file_name) if os.path.isfile(name)]
+    else:
+        file_names = [input_file_name]
+    if not file_names:
+        raise FileNotFoundError("No corpus files match {}".format(input_file_name))
+    return sorted(file_names)
+
+
+def _count_file(file_name):
+    with open(file_name, 'r', encoding="utf-8") as fin:
+        return _count_chunk(fin)
+
+
+def count_files(file_names, workers=1):
+    """
+    Count the words of several corpus files, streaming each file line by line.
+    :param workers: (int) : number of processes, each counting whole files
+    :return: (Counter) : word -> count, merged over all files
+    """
+    counts = Counter()
+    if workers <= 1:
+        for file_name in file_names:
+            counts.update(_count_file(file_name))
+        return counts
+    with multiprocessing.Pool(workers) as pool:
+        for file_counts in pool.imap_unordered(_count_file, file_names):
+            counts.update(file_counts)
+    return counts
+
+
+def _count_chunk(sentences):
+    counts = Counter()
+    for sentence in sentences:
+        counts.update(preprocess(sentence).split(' '))
+    return counts
+
+
+def count_words(sentences, workers=1):
+    """
+    Count the words of preprocessed sentences in one pass.
+    :param workers: (int) : number of processes counting contiguous chunks of sentences
+    :return: (Counter) : word -> count, merged over all chunks
+    """
+    if workers <= 1:
+        return _count_chunk(sentences)
+    chunk_size = (len(sentences) + workers - 1) // workers
+    chunks = [sentences[i:i + chunk_size] for i in range(0, len(sentences), chunk_size)]
+    counts = Counter()
+    with multiprocessing.Pool(workers) as pool:
+        for chunk_counts in pool.imap_unordered(_count_chunk, chunks):
+            counts.update(chunk_counts)
+    return counts
+
+
+def load_embedding(file_name, output_format="text"):
+    """
+    Load embeddings written by SkipGram.save_embedding.
+    :param output_format: (str) : "text", "binary" or "npy"
+    :return: (List[str], np.ndarray) : words and the [vocab_dim, embedding_dim] matrix
+    - For "npy" the matrix is memory-mapped read-only, so opening it does not read the file.
+    """
+    if output_format == "npy":
+        with open(file_name + '.vocab', 'r', encoding="utf-8") as fin:
+            words = [line.rstrip('\n') for line in fin]
+        return words, np.load(file_name, mmap_mode='r')
+
+    if output_format == "binary":
+        with open(file_name, 'rb') as fin:
+            data = fin.read()
+        pos = data.index(b'\n') + 1
+        num_words, dim = map(int, data[:pos].split())
+        words = []
+        embedding = np.empty((num_words, dim), dtype=np.float32)
+        for w_id in range(num_words):
+            space = data.index(b' ', pos)
+            words.append(data[pos:space].decode('utf-8'))
+            embedding[w_id] = np.frombuffer(data, dtype=np.float32, count=dim, offset=space + 1)
+            pos = space + 1 + 4 * dim
+            if data[pos:pos + 1] == b'\n':
+                pos += 1
+        return words, embedding
+
+    with open(file_name, 'r', encoding="utf-8") as fin:
+        num_words, dim = map(int, fin.readline().split())
+        words = []
+        embedding = np.empty((num_words, dim))
+        for w_id, line in enumerate(fin):
+            values = line.rstrip('\n').split(' ')
+            words.append(values[0])
+            embedding[w_id] = np.asarray(values[1:], dtype=np.float64)
+    return words, embedding
+
+
+def _render_projection(words, embedding, file_name, top_k, pca_dim):
+    try:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+    except ModuleNotFoundError:
+        print("Please install matplotlib to see visualization.")
+        return
+
+    points = None
+    cache_file_name = file_name + '.tsne.npz'
+    if os.path.isfile(cache_file_name) and os.path.getmtime(cache_file_name) >= os.path.getmtime(file_name):
+        cache = np.load(cache_file_name)
+        if cache['top_k'] == top_k and cache['pca_dim'] == pca_dim and list(cache['words']) == words:
+            points = cache['points']
+
+    if points is None:
+        try:
+            from sklearn.manifold import TSNE
+        except ModuleNotFoundError:
+            print("Please install sklearn to see visualization.")
+            return
+        if 0 < pca_dim < embedding.shape[1]:
+            centered = embedding - embedding.mean(axis=0)
+            _, _, vt = np.linalg.svd(centered, full_matrices=False)
+            embedding = centered.dot(vt[:pca_dim].T)
+        points = TSNE(n_components=2, perplexity=min(30, len(words) - 1)).fit_transform(embedding)
+        np.savez(cache_file_name, words=np.array(words), points=points, top_k=top_k, pca_dim=pca_dim)
+
+    for word, (x, y) in zip(words, points):
+        plt.scatter(x, y)
+        plt.annotate(word, xy=(x, y), xytext=(5, 2), textcoords='offset points', ha='right', va='bottom')
+    plt.savefig(file_name + '.png')
+    plt.close()
+    print("Save visualization at {}".format(file_name + '.png'))
+
+
+def print_epoch_stats(stats):
+    """
+    Default callback of SkipGram.train, called after every epoch with a dict of
+    epoch, num_pairs, loss (mean per pair), improvement (relative to the previous epoch),
+    learning_rate and pairs_per_sec. In pipeline mode it also has producer_stall and consumer_stall,
+    the seconds spent waiting on a full and on an empty queue.
+    """
+    message = "epoch {epoch}: loss {loss:.4f}, lr {learning_rate:.5f}, {pairs_per_sec:.0f} pairs/sec".format(**stats)
+    if 'consumer_stall' in stats:
+        message += ", stalls: producers {producer_stall:.2f}s, updater {consumer_stall:.2f}s".format(**stats)
+    tqdm.write(message)
+
+
+class Profiler:
+
+    """
+    Wall-clock totals and call counts per training phase, plus counters per epoch.
+    SkipGram.enable_profiling wraps the instance's phase methods with Profiler.wrap, so a SkipGram
+    without a profiler runs exactly the same code as before and pays nothing for it.
+    Phases may nest (batch_update includes output_step). Hogwild workers and process pipeline producers
+    get an unprofiled copy of the SkipGram (see SkipGram.__getstate__), so their phases are not timed.
+    Thread pipeline producers are timed, but run concurrently with the updater, so the phase totals
+    of a pipeline epoch can add up to more than its wall-clock time.
+    """
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.epochs = []
+        # Thread pipeline producers update the totals concurrently with the updater.
+        self.lock = threading.Lock()
+
+    def wrap(self, phase, method, count=None):
+        """
+        :param phase: (str) : name of the phase in the summary
+        :param method: (callable) : method to time
+        :param count: (callable) : optional count(args, result) -> Dict[str, int] of counters to add
+        :return: (callable) : timed method
+        """
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = method(*args, **kwargs)
+            seconds = time.perf_counter() - start
+            counts = count(args, result) if count is not None else {}
+            with self.lock:
+                self.totals[phase] += seconds
+                self.calls[phase] += 1
+                for (name, value) in counts.items():
+                    self.counters[name] += int(value)
+            return result
+        return timed
+
+    def end_epoch(self, epoch, num_pairs, seconds):
+        self.epochs.append(dict(self.counters, epoch=epoch, pairs=num_pairs, seconds=seconds))
+        self.counters.clear()
+
+    def summary(self):
+        """
+        :return: (str) : table of the phases sorted by total time, followed by the per-epoch counters
+        """
+        lines = ['{:<20s} {:>10s} {:>12s} {:>14s}'.format('phase', 'calls', 'total (s)', 'per call (us)')]
+        for phase in sorted(self.totals, key=self.totals.get, reverse=True):
+            lines.append('{:<20s} {:>10d} {:>12.3f} {:>14.2f}'.format(
+                phase, self.calls[phase], self.totals[phase], 1e6 * self.totals[phase] / self.calls[phase]))
+        lines.append('')
+        lines.append('{:>6s} {:>12s} {:>14s} {:>14s} {:>10s}'.format(
+            'epoch', 'pairs', 'negatives', 'rows updated', 'seconds'))
+        for stats in self.epochs:
+            lines.append('{:>6d} {:>12d} {:>14d} {:>14d} {:>10.2f}'.format(
+                stats['epoch'], stats['pairs'], stats.get('negatives', 0), stats.get('rows_updated', 0),
+                stats['seconds']))
+        return '\n'.join(lines)
+
+    def dump(self, file_name):
+        with open(file_name, 'w') as fout:
+            json.dump({'phases': {phase: {'calls': self.calls[phase], 'seconds': self.totals[phase]}
+                                  for phase in self.totals},
+                       'epochs': self.epochs}, fout, indent=2)
+
+
+class _IndexView(Mapping):
+
+    """Read-only index -> item mapping over a list or array, standing in for the old index2* dicts."""
+
+    __slots__ = ('sequence',)
+
+    def __init__(self, items):
+        self.sequence = items
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self.sequence):
+            raise KeyError(index)
+        return self.sequence[index]
+
+    def __iter__(self):
+        return iter(range(len(self.sequence)))
+
+    def __len__(self):
+        return len(self.sequence)
+
+
+class _CountView(Mapping):
+
+    """Read-only word -> count mapping, standing in for the old word2count dict."""
+
+    __slots__ = ('vocab',)
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def __getitem__(self, word):
+        return self.vocab.counts[self.vocab.word2index[word]]
+
+    def __iter__(self):
+        return iter(self.vocab.words)
+
+    def __len__(self):
+        return self.vocab.num_words
+
+
 class Vocabulary:
 
-    """Do not modify this class"""
+    """
+    Words in a list, their counts in an int64 array and a single word -> index dict.
+    index2word, index2count and word2count are read-only views kept for code written against
+    the old four-dict vocabulary; new code should use words, counts and lookup.
+    """
+
+    __slots__ = ('trimmed', 'word2index', 'words', '_counts', 'num_words', 'total_words')
 
     def __init__(self):
         self.trimmed = False
         self.word2index = {}
-        self.word2count = {}
-        self.index2word = {}
-        self.index2count = {}
+        self.words = []
+        self._counts = np.zeros(16, dtype=np.int64)
         self.num_words = 0
         self.total_words = 0
 
-    def init_dict(self, sentences, min_count, max_count):
-        for line in sentences:
-            self.add_sentence(line)
+    @property
+    def counts(self):
+        """
+        :return: [num_words] (np.ndarray) : int64 count of every word, by index
+        """
+        return self._counts[:self.num_words]
+
+    @property
+    def index2word(self):
+        return _IndexView(self.words)
+
+    @property
+    def index2count(self):
+        return _IndexView(self.counts)
+
+    @property
+    def word2count(self):
+        return _CountView(self)
+
+    def lookup(self, words, default=-1):
+        """
+        :param words: (Sequence[str])
+        :return: [len(words)] (np.ndarray) : int64 index of every word, default for unknown words
+        """
+        get = self.word2index.get
+        return np.fromiter((get(word, default) for word in words), dtype=np.int64, count=len(words))
+
+    def init_dict(self, sentences, min_count, max_count, workers=1):
+        self.init_counts(count_words(sentences, workers), min_count, max_count)
+
+    def init_counts(self, word_counts, min_count, max_count):
+        """
+        Same as init_dict, from word counts that are already computed (see count_files).
+        :param word_counts: (Dict[str, int])
+        """
+        if self.num_words == 0:
+            self.words = list(word_counts)
+            self.word2index = {word: w_id for (w_id, word) in enumerate(self.words)}
+            self._counts = np.fromiter(word_counts.values(), dtype=np.int64, count=len(self.words))
+            self.num_words = len(self.words)
+        else:
+            for (word, count) in word_counts.items():
+                self.add_word(word, count)
 
         self.trim(min_count, max_count)
 
-        for (k, c) in self.word2count.items():
-            self.total_words += c
+        self.total_words += int(self.counts.sum())
+
+    def update(self, sentences, min_count, max_count, workers=1):
+        """
+        Add the counts of new sentences to a trimmed vocabulary.
+        Words already in the vocabulary keep their index; new words that appear at least min_count
+        (and less than max_count) times in the new sentences are appended in ascending (count, word) order.
+        :return: (int) : number of appended words
+        """
+        num_words = self.num_words
+        word_counts = count_words(sentences, workers)
+        words = list(word_counts)
+        counts = np.fromiter(word_counts.values(), dtype=np.int64, count=len(words))
+        indices = self.lookup(words)
+        known = indices >= 0
+        np.add.at(self._counts, indices[known], counts[known])
+        self.total_words += int(counts[known].sum())
+
+        for (count, word) in sorted((c, w) for (c, w, k) in zip(counts.tolist(), words, known) if not k):
+            if min_count <= count < max_count:
+                self.add_word(word, count)
+                self.total_words += count
+        return self.num_words - num_words
 
     def add_sentence(self, sentence):
         sentence = preprocess(sentence)
         for word in sentence.split(' '):
             self.add_word(word)
 
-    def add_word(self, word):
-        if word not in self.word2index:
+    def add_word(self, word, count=1):
+        index = self.word2index.get(word)
+        if index is None:
+            if self.num_words == len(self._counts):
+                self._counts = np.concatenate([self._counts, np.zeros_like(self._counts)])
             self.word2index[word] = self.num_words
-            self.word2count[word] = 1
-            self.index2word[self.num_words] = word
-            self.index2count[self.num_words] = 1
+            self.words.append(word)
+            self._counts[self.num_words] = count
             self.num_words += 1
         else:
-            self.word2count[word] += 1
-            self.index2count[self.word2index[word]] += 1
+            self._counts[index] += count
+
+    def save(self, file_name):
+        with open(file_name, 'w', encoding="utf-8") as fout:
+            for (word, count) in zip(self.words, self.counts.tolist()):
+                fout.write('%s\t%d\n' % (word, count))
+
+    def load(self, file_name):
+        with open(file_name, 'r', encoding="utf-8") as fin:
+            for line in fin:
+                word, count = line.rstrip('\n').split('\t')
+                self.add_word(word, int(count))
+                self.total_words += int(count)
+        self.trimmed = True
 
     # Remove words below a certain count threshold
     def trim(self, min_count, max_count):
         if self.trimmed:
             return
         self.trimmed = True
-        q = queue.PriorityQueue()
-        keep_words = 0
-        for (k, v) in self.word2count.items():
-            if v >= min_count:
-                keep_words += 1
-                q.put((v, k))
+        # Indices are assigned in ascending (count, word) order.
+        keep = sorted((v, k) for (k, v) in zip(self.words, self.counts.tolist()) if v >= min_count)
+        keep_words = len(keep)
 
         print('Words to Keep: {} / {} = {:.2f}%'.format(
-            keep_words, len(self.word2index), 100 * keep_words / len(self.word2index)))
+            keep_words, self.num_words, 100 * keep_words / self.num_words))
 
-        # Reinitialize dictionaries
-        self.word2index = {}
-        self.word2count = {}
-        self.index2word = {}
-        self.index2count = {}
-        self.num_words = 0
+        # Reinitialize the word list, the counts and the index
+        keep = [(freq, word) for (freq, word) in keep if freq < max_count]
+        self.words = [word for (_, word) in keep]
+        self.word2index = {word: w_id for (w_id, word) in enumerate(self.words)}
+        self._counts = np.array([freq for (freq, _) in keep] or [0], dtype=np.int64)
+        self.num_words = len(keep)
+
+
+def sentences_with_progress(corpus, num_tokens=1 << 16):
+    """
+    :param corpus: (Corpus or ShardedCorpus)
+    :return: (Iterator[(np.ndarray, float)]) : every sentence with the fraction of the corpus' tokens before it
+    """
+    for block, start, end in corpus.progress_blocks(num_tokens):
+        offsets = np.asarray(block.offsets)
+        fractions = start + (end - start) * offsets[:-1] / max(int(offsets[-1]), 1)
+        yield from zip(block, fractions.tolist())
+
+
+class Corpus:
+
+    """
+    Pre-tokenized corpus: the vocabulary indices of all sentences in one flat int32 array,
+    plus an int64 array of sentence offsets (sentence i is tokens[offsets[i]:offsets[i + 1]]).
+    """
+
+    def __init__(self, tokens, offsets):
+        self.tokens = tokens
+        self.offsets = offsets
+
+    @classmethod
+    def compile(cls, sentences, vocab):
+        """
+        Tokenize sentences once. Words that are not in the vocabulary are dropped, as in subsampling.
+        """
+        words, lengths = [], []
+        for sentence in sentences:
+            sentence_words = preprocess(sentence).strip().split(' ')
+            words += sentence_words
+            lengths.append(len(sentence_words))
+        tokens = vocab.lookup(words)
+        known = tokens >= 0
+        kept_before = np.concatenate([[0], np.cumsum(known)])
+        offsets = kept_before[np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)])]
+        return cls(tokens[known].astype(np.int32), offsets.astype(np.int64))
+
+    @staticmethod
+    def source_stamp(input_file_name):
+        """
+        :return: (dict) : absolute path, size and modification time of the input file a cache was built from
+        """
+        stat = os.stat(input_file_name)
+        return {"path": os.path.abspath(input_file_name), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+    @staticmethod
+    def cache_prefix(cache_dir, input_file_name, min_count, max_count):
+        # Equally named input files of different directories get different caches.
+        path_hash = hashlib.sha1(os.path.abspath(input_file_name).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(cache_dir, '{}.{}.min{}.max{}'.format(
+            os.path.basename(input_file_name), path_hash, min_count, max_count))
+
+    @staticmethod
+    def is_cached(prefix, input_file_name):
+        try:
+            with open(prefix + '.source.json') as fin:
+                source = json.load(fin)
+        except (OSError, ValueError):
+            return False
+        return source == Corpus.source_stamp(input_file_name)
 
-        while not q.empty():
-            freq, word = q.get()
-            if freq < max_count:
-                for _ in range(freq):
-                    self.add_word(word)
+    def save(self, prefix, source):
+        """
+        :param source: (dict) : source_stamp of the input file, taken before it was read
+        """
+        np.save(prefix + '.offsets.npy', self.offsets)
+        np.save(prefix + '.tokens.npy', self.tokens)
+        # Written last, so that is_cached only sees a complete cache.
+        with open(prefix + '.source.json', 'w') as fout:
+            json.dump(source, fout)
+
+    @classmethod
+    def load(cls, prefix):
+        return cls(np.load(prefix + '.tokens.npy', mmap_mode='r'), np.load(prefix + '.offsets.npy', mmap_mode='r'))
+
+    def subsample(self, keep_prob):
+        """
+        Subsample the whole token buffer with a single random draw.
+        :param keep_prob: [vocab_dim] (np.ndarray) : probability of keeping each vocabulary entry
+        :return: (Corpus) : the kept tokens, with offsets of the same sentences
+        """
+        start, end = int(self.offsets[0]), int(self.offsets[-1])
+        tokens = self.tokens[start:end]
+        keep = np.random.random(len(tokens)) > (1 - keep_prob[tokens])
+        kept_before = np.concatenate([[0], np.cumsum(keep)])
+        return Corpus(tokens[keep], kept_before[np.asarray(self.offsets) - start])
+
+    def blocks(self, num_tokens=1 << 16):
+        """
+        :param num_tokens: (int) : approximate number of tokens per block
+        :return: (Iterator[Corpus]) : consecutive ranges of whole sentences, each with offsets starting at 0
+        """
+        offsets = np.asarray(self.offsets)
+        start = 0
+        while start < len(offsets) - 1:
+            end = max(int(np.searchsorted(offsets, offsets[start] + num_tokens, side='right')) - 1, start + 1)
+            end = min(end, len(offsets) - 1)
+            yield Corpus(self.tokens[offsets[start]:offsets[end]], offsets[start:end + 1] - offsets[start])
+            start = end
+
+    def progress_blocks(self, num_tokens=1 << 16):
+        """
+        :return: (Iterator[(Corpus, float, float)]) : the blocks of blocks(num_tokens), each with the fractions
+            of this corpus' tokens read before its start and by its end
+        """
+        total = max(int(self.offsets[-1] - self.offsets[0]), 1)
+        read = 0
+        for block in self.blocks(num_tokens):
+            start, read = read, read + int(block.offsets[-1])
+            yield block, start / total, read / total
+
+    def shard(self, shard_id, num_shards):
+        """
+        :return: (Corpus) : a contiguous range of sentences sharing this corpus' token buffer
+        """
+        shard_size = (len(self) + num_shards - 1) // num_shards
+        start = min(shard_id * shard_size, len(self))
+        end = min(start + shard_size, len(self))
+        return Corpus(self.tokens, self.offsets[start:end + 1])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        offsets = self.offsets.tolist()
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            yield self.tokens[start:end]
+
+
+class ShardedCorpus:
+
+    """
+    Corpus split over several files. A shard is read and tokenized only while it is being iterated,
+    so at most one shard per reader is in memory. Offers the part of the Corpus interface used for
+    training: iteration over sentences, subsample, blocks and shard.
+    """
+
+    def __init__(self, file_names, vocab, subsample_shard=None):
+        """
+        :param file_names: (List[str]) : shard files, in the order they are read
+        :param subsample_shard: (Callable[[Corpus], Corpus]) : applied to every shard when it is read, or None
+        """
+        self.file_names = list(file_names)
+        self.vocab = vocab
+        self.subsample_shard = subsample_shard
+
+    def shuffled(self):
+        """
+        :return: (ShardedCorpus) : the same shards in a random order
+        """
+        return ShardedCorpus([self.file_names[i] for i in np.random.permutation(len(self.file_names))],
+                             self.vocab, self.subsample_shard)
+
+    def shards(self):
+        """
+        :return: (Iterator[Corpus]) : every shard, tokenized (and subsampled) when it is reached
+        """
+        for file_name in self.file_names:
+            with open(file_name, 'r', encoding="utf-8") as fin:
+                corpus = Corpus.compile(fin, self.vocab)
+            if self.subsample_shard is not None:
+                corpus = self.subsample_shard(corpus)
+            yield corpus
+
+    def subsample(self, keep_prob):
+        return ShardedCorpus(self.file_names, self.vocab, functools.partial(Corpus.subsample, keep_prob=keep_prob))
+
+    def blocks(self, num_tokens=1 << 16):
+        for corpus in self.shards():
+            yield from corpus.blocks(num_tokens)
+
+    def progress_blocks(self, num_tokens=1 << 16):
+        """
+        See Corpus.progress_blocks. The token counts of the shards are only known once they are read,
+        so each shard covers a share of the progress proportional to its file size.
+        """
+        sizes = np.array([os.path.getsize(file_name) for file_name in self.file_names], dtype=np.float64)
+        bounds = (np.concatenate([[0.], np.cumsum(sizes)]) / max(sizes.sum(), 1.)).tolist()
+        for corpus, shard_start, shard_end in zip(self.shards(), bounds[:-1], bounds[1:]):
+            for block, start, end in corpus.progress_blocks(num_tokens):
+                span = shard_end - shard_start
+                yield block, shard_start + span * start, shard_start + span * end
+
+    def shard(self, shard_id, num_shards):
+        """
+        :return: (ShardedCorpus) : every num_shards-th file, starting from shard_id
+        """
+        return ShardedCorpus(self.file_names[shard_id::num_shards], self.vocab, self.subsample_shard)
+
+    def __iter__(self):
+        for corpus in self.shards():
+            yield from corpus
+
+
+class AliasSampler:
+
+    """Walker's alias method: O(vocab) to build, O(1) per draw."""
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        num_words = len(weights)
+        prob = (weights * num_words / weights.sum()).tolist()
+        alias = [0] * num_words
+        small = [i for i, p in enumerate(prob) if p < 1.0]
+        large = [i for i, p in enumerate(prob) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            alias[s] = l
+            prob[l] = prob[l] + prob[s] - 1.0
+            if prob[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        for i in small + large:
+            prob[i] = 1.0
+        self.prob = np.asarray(prob)
+        self.alias = np.asarray(alias, dtype=np.int64)
+
+    def sample(self, size):
+        """
+        :param size: (int or tuple) : shape of the output
+        :return: (np.ndarray) : word indices drawn from the distribution
+        """
+        index = np.random.randint(len(self.prob), size=size)
+        return np.where(np.random.random(size) < self.prob[index], index, self.alias[index])
+
+
+class CumulativeSampler:
+
+    """Inverse-CDF sampling with np.searchsorted: O(vocab) to build, O(log vocab) per draw."""
+
+    def __init__(self, weights):
+        self.cdf = np.cumsum(np.asarray(weights, dtype=np.float64))
+
+    def sample(self, size):
+        """
+        :param size: (int or tuple) : shape of the output
+        :return: (np.ndarray) : word indices drawn from the distribution
+        """
+        index = np.searchsorted(self.cdf, np.random.random(size) * self.cdf[-1], side='right')
+        return np.minimum(index, len(self.cdf) - 1)
+
+
+NEGATIVE_SAMPLERS = {"alias": AliasSampler, "cdf": CumulativeSampler}
+
+
+class SigmoidTable:
+
+    """
+    Sigmoid precomputed at size points over [-bound, bound], as the expTable of the reference C word2vec.
+    A lookup returns the value at the midpoint of the cell x falls in, so the error is below bound / (4 * size).
+    """
+
+    def __init__(self, size=1000, bound=6, dtype=np.float64):
+        self.size = size
+        self.bound = bound
+        self.scale = size / (2. * bound)
+        # One extra entry so that x == bound needs no clipping.
+        self.values = sigmoid((np.arange(size + 1) + 0.5) / self.scale - bound).astype(dtype)
+        self.scalar_values = self.values.tolist()
+
+    def __call__(self, x):
+        """
+        :param x: (np.ndarray) : logits; values outside [-bound, bound] get the first or last entry
+        :return: (np.ndarray) : sigmoid of x
+        """
+        return self.values.take(((x + self.bound) * self.scale).astype(np.intp), mode='clip')
+
+    def scalar(self, x):
+        """
+        Lookup of a single logit within [-bound, bound], without numpy array overhead.
+        """
+        return self.scalar_values[int((x + self.bound) * self.scale)]
+
+
+class HuffmanTree:
+
+    """
+    Huffman tree over word counts for hierarchical softmax. Inner node i (0 <= i < vocab_dim - 1)
+    is row i of W_prime. For every word, the inner nodes on its path from the root and the binary
+    code of each branch are stored in [vocab_dim, max_depth] arrays, padded past code_lengths[word].
+    """
+
+    def __init__(self, counts):
+        num_words = len(counts)
+        heap = [(count, node) for (node, count) in enumerate(counts)]
+        heapq.heapify(heap)
+        parent = np.zeros(max(2 * num_words - 1, 1), dtype=np.int64)
+        binary = np.zeros(max(2 * num_words - 1, 1), dtype=np.uint8)
+        next_node = num_words
+        while len(heap) > 1:
+            count1, node1 = heapq.heappop(heap)
+            count2, node2 = heapq.heappop(heap)
+            parent[node1] = parent[node2] = next_node
+            binary[node2] = 1
+            heapq.heappush(heap, (count1 + count2, next_node))
+            next_node += 1
+        root = next_node - 1
+
+        paths = []
+        for word in range(num_words):
+            node, code, point = word, [], []
+            while node != root:
+                code.append(binary[node])
+                node = parent[node]
+                point.append(node - num_words)
+            paths.append((code[::-1], point[::-1]))
+
+        self.code_lengths = np.array([len(code) for (code, _) in paths], dtype=np.int32)
+        max_depth = max(int(self.code_lengths.max()), 1)
+        self.codes = np.zeros((num_words, max_depth), dtype=np.uint8)
+        self.points = np.zeros((num_words, max_depth), dtype=np.int32)
+        for word, (code, point) in enumerate(paths):
+            self.codes[word, :len(code)] = code
+            self.points[word, :len(point)] = point
+
+    def path(self, words):
+        """
+        :param words: [batch] (np.ndarray) : word indices
+        :return: ([batch, max_depth] (np.ndarray), [batch, max_depth] (np.ndarray), [batch, max_depth] (np.ndarray)) :
+            inner nodes (rows of W_prime), labels (1 - code) and a mask of the entries on each path
+        """
+        points = self.points[words]
+        labels = 1. - self.codes[words]
+        mask = np.arange(self.points.shape[1]) < self.code_lengths[words][:, None]
+        return points, labels, mask
+
+
+OBJECTIVES = ("ns", "hs")
 
 
 class SkipGram:
 
-    def __init__(self, vocab, embedding_dimension):
+    def __init__(self, vocab, embedding_dimension, negative_sampler=AliasSampler, objective="ns", dtype=np.float32,
+                 sigmoid_table_size=1000):
+        """
+        :param negative_sampler: (callable) : builds the noise distribution sampler from unnormalized
+            word weights; the result must provide sample(size). See AliasSampler and CumulativeSampler.
+        :param objective: (str) : "ns" for negative sampling or "hs" for hierarchical softmax
+        :param dtype: (np.dtype) : floating point type of W, W_prime and every update computed from them
+        :param sigmoid_table_size: (int) : number of entries of the precomputed sigmoid used by backward and
+            backward_batch (see SigmoidTable), or 0 to compute the sigmoid exactly
+        """
         self.sentences = []
+        self.corpus = None
         self.vocab = vocab
         self.embed_dim = embedding_dimension
         self.W = None
         self.W_prime = None
-        self.table = []
+        self.negative_sampler = negative_sampler
+        self.sampler = None
+        self.objective = objective
+        self.dtype = np.dtype(dtype)
+        self.sigmoid_table = SigmoidTable(sigmoid_table_size, dtype=self.dtype) if sigmoid_table_size > 0 else None
+        self.tree = None
+        self.keep_prob = None
+        self.keep_prob_bound = None
+        self.profiler = None
+        self.pipeline_stalls = None
+
+    def __getstate__(self):
+        """
+        Pickle without the profiler: the timed wrappers that enable_profiling sets on the instance are closures,
+        which cannot be sent to Hogwild workers or process producers under the spawn or forkserver start methods.
+        """
+        state = dict(self.__dict__, profiler=None)
+        for name in list(state):
+            if callable(state[name]) and callable(getattr(type(self), name, None)):
+                del state[name]
+        return state
+
+    def enable_profiling(self):
+        """
+        Time the phases of training with a Profiler, available as self.profiler.
+        """
+        profiler = self.profiler = Profiler()
+        for (phase, name, count) in [
+                ('load_corpus', 'load_corpus', None),
+                ('init_output_layer', 'init_unigram_table', None),
+                ('init_output_layer', 'init_huffman_tree', None),
+                ('subsampling', 'subsample_indices', None),
+                ('subsampling', 'subsample_corpus', None),
+                ('windows', 'window_pairs', None),
+                ('windows', 'window_contexts', None),
+                ('negatives', 'draw_negatives', lambda args, result: {'negatives': result.size}),
+                ('forward', 'forward', None),
+                ('backward', 'backward', None),
+                ('backward', 'backward_batch', None),
+                ('optimize', 'optimize', lambda args, result: {'rows_updated': 2 * len(args[1])}),
+                ('optimize', 'optimize_window',
+                 lambda args, result: {'rows_updated': len(args[1]) + len(args[2])}),
+                ('batch_update', 'train_batch', lambda args, result: {'rows_updated': int((args[1] >= 0).sum())}),
+                ('output_step', 'output_step', lambda args, result: {'rows_updated': int(args[4].sum())}),
+                ('save_embedding', 'save_embedding', None)]:
+            if hasattr(self, name):
+                setattr(self, name, profiler.wrap(phase, getattr(self, name), count))
 
     def init_unigram_table(self):
-        table_size = 1e8
-        pow_frequency = np.array(list(self.vocab.index2count.values())) ** 0.75
-        word_pow_sum = np.sum(pow_frequency)
-        ratio_array = pow_frequency / word_pow_sum
-        word_count_list = np.around(ratio_array * table_size)
-        for word_index, word_freq in enumerate(tqdm(word_count_list)):
-            self.table.append(np.asarray([word_index] * int(word_freq)))
-        self.table = np.concatenate(self.table)
+        pow_frequency = self.vocab.counts ** 0.75
+        self.sampler = self.negative_sampler(pow_frequency)
 
-    def save_embedding(self, file_name):
+    def init_huffman_tree(self):
+        self.tree = HuffmanTree(self.vocab.counts.tolist())
+
+    def save_embedding(self, file_name, output_format="text"):
+        """
+        :param output_format: (str) : "text" (one word and its floats per line), "binary" (the word2vec
+            binary format) or "npy" (a float32 matrix plus a sidecar file of words, see load_embedding)
+        """
 
         embedding = self.W
 
-        fout = open(file_name, 'w')
-        fout.write('%d %d\n' % (len(self.vocab.index2word), self.embed_dim))
-        for (w_id, word) in self.vocab.index2word.items():
-            e = embedding[w_id]
-            fout.write('%s %s\n' % (word, " ".join(map(lambda x: str(x), e))))
+        if output_format == "binary":
+            with open(file_name, 'wb') as fout:
+                fout.write(b'%d %d\n' % (self.vocab.num_words, self.embed_dim))
+                for (w_id, word) in enumerate(self.vocab.words):
+                    fout.write(word.encode('utf-8') + b' ')
+                    fout.write(np.asarray(embedding[w_id], dtype=np.float32).tobytes())
+                    fout.write(b'\n')
+        elif output_format == "npy":
+            with open(file_name, 'wb') as fout:
+                np.save(fout, np.asarray(embedding, dtype=np.float32))
+            with open(file_name + '.vocab', 'w', encoding="utf-8") as fout:
+                for word in self.vocab.words:
+                    fout.write(word + '\n')
+        else:
+            fout = open(file_name, 'w')
+            fout.write('%d %d\n' % (self.vocab.num_words, self.embed_dim))
+            for (w_id, word) in enumerate(self.vocab.words):
+                e = embedding[w_id]
+                fout.write('%s %s\n' % (word, " ".join(map(lambda x: str(x), e))))
+            fout.close()
 
-        try:
-            from sklearn.manifold import TSNE
-            import matplotlib.pyplot as plt
-            embedding = TSNE(n_components=2).fit_transform(embedding)
-            for (w_id, word) in self.vocab.index2word.items():
-                x, y = embedding[w_id]
-                plt.scatter(x, y)
-                plt.annotate(word, xy=(x, y), xytext=(5, 2), textcoords='offset points', ha='right', va='bottom')
-            plt.show()
-        except ModuleNotFoundError:
-            print("Please install matplotlib to see visualization.")
+    def visualize(self, file_name, top_k=500, pca_dim=50, background=True):
+        """
+        Render a t-SNE scatter plot of the top_k most frequent words to file_name + '.png'.
+        The 2D projection is cached in file_name + '.tsne.npz' and reused while it is newer than
+        the embedding file and was computed with the same top_k and pca_dim.
+        :param file_name: (str) : embedding file written by save_embedding
+        :param top_k: (int) : number of most frequent words to project
+        :param pca_dim: (int) : reduce to this many dimensions with PCA before t-SNE (0 to skip)
+        :param background: (bool) : render in a separate process instead of blocking
+        :return: (multiprocessing.Process or None) : the rendering process when background is set
+        """
+        counts = self.vocab.counts
+        w_ids = np.sort(np.argsort(-counts, kind='stable')[:top_k])
+        words = [self.vocab.words[w_id] for w_id in w_ids.tolist()]
+        args = (words, np.asarray(self.W[w_ids]), file_name, top_k, pca_dim)
+        if not background:
+            _render_projection(*args)
+            return None
+        process = multiprocessing.Process(target=_render_projection, args=args)
+        process.start()
+        return process
 
     def forward(self, index1, index2, W, W_prime):
         """
@@ -182,11 +1034,29 @@ class SkipGram:
             gradient = (label - 1)
         elif forwards < - bound:
             gradient = (label - 0)
+        elif self.sigmoid_table is not None:
+            gradient = label - self.sigmoid_table.scalar(forwards)
         else:
             gradient = label - sigmoid(forwards)
             # raise NotImplementedError
         return gradient
 
+    def backward_batch(self, forwards, labels):
+        """
+        Array version of backward, with the same saturation at |forwards| > 6.
+        :param forwards: (np.ndarray) : logits, the results of forward
+        :param labels: (np.ndarray) : labels of the same shape, 1 for positive and 0 for negative words
+        :return: (np.ndarray) : gradient scalars, label - sigmoid(forwards)
+        """
+        bound = 6
+        if self.sigmoid_table is not None:
+            sigm = self.sigmoid_table(forwards)
+        else:
+            sigm = sigmoid(np.clip(forwards, -bound, bound))
+        sigm[forwards > bound] = 1
+        sigm[forwards < -bound] = 0
+        return labels - sigm
+
     def optimize(self, learning_rate, gradients, W, W_prime):
         """
         Implement stochastic gradient descent algorithm!
@@ -200,7 +1070,8 @@ class SkipGram:
         You should update weights by adding or subtracting learning_rate * gradient value.
         There's no return value.
         """
-        W_prime_original = deepcopy(W_prime)
+        # Snapshot only the W_prime rows touched by this step instead of copying the whole matrix.
+        W_prime_original = {context_i: W_prime[context_i].copy() for _, _, context_i in gradients}
 
         # Update W_prime with W and grad.
         for grad, center_i, context_i in gradients:
@@ -210,7 +1081,7 @@ class SkipGram:
         # Update W with W_prime_original and grad.
         for grad, center_i, context_i in gradients:
             # raise NotImplementedError
-            W[center_i, :] = W[center_i, :] + learning_rate * grad * W_prime_original[context_i, :]
+            W[center_i, :] = W[center_i, :] + learning_rate * grad * W_prime_original[context_i]
 
     def subsampling(self, sample_bound, sentence):
         """
@@ -228,100 +1099,745 @@ class SkipGram:
         When you generate a random number, you should not use built-in random.random() but numpy.random.random()
         """
         # sample_bound = 1e-5
-        sampled_word_indices = []
-        for word in sentence.strip().split(' '):
-            if self.vocab.word2count.get(word) is None:
-                continue
-            else:
-                frequency = self.vocab.word2count.get(word)
-                p = (frequency - sample_bound) / frequency - np.sqrt(sample_bound / frequency)
-                randomVariable = np.random.random()
-                if randomVariable > (1-p):
-                    sampled_word_indices.append(self.vocab.word2index.get(word))
-                
+        indices = [self.vocab.word2index[word] for word in sentence.strip().split(' ') if word in self.vocab.word2index]
+        return self.subsample_indices(sample_bound, indices)
 
-                # raise NotImplementedError
-        return sampled_word_indices
+    def subsample_indices(self, sample_bound, indices):
+        """
+        Same as subsampling, but for a sentence that is already a sequence of vocabulary indices.
+        :param sample_bound: (float) : threshold (t) of Exercise 1-2
+        :param indices: (Sequence[int]) : vocabulary indices of a sentence
+        :return: (List[int]) : indices of subsampled words
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        keep = np.random.random(len(indices)) > (1 - self.keep_probabilities(sample_bound)[indices])
+        return indices[keep].tolist()
 
-    def train(self, input_file_name, output_file_name,
-              total_epoch, learning_rate, min_count, max_count, window_size, num_negative, sample_bound,
-              debug):
-        np.random.seed(6)
+    def subsample_corpus(self, corpus, sample_bound):
+        """
+        Subsample a whole corpus (or shard of it) with keep_probabilities, for the batched train modes.
+        A ShardedCorpus is subsampled through this method shard by shard as it is read, so that profiling
+        also times it for sharded input and in every pipeline producer or Hogwild worker.
+        :return: (Corpus or ShardedCorpus)
+        """
+        if isinstance(corpus, ShardedCorpus):
+            return ShardedCorpus(corpus.file_names, corpus.vocab,
+                                 functools.partial(self.subsample_corpus, sample_bound=sample_bound))
+        return corpus.subsample(self.keep_probabilities(sample_bound))
 
-        if debug:
-            pdb.set_trace()
+    def keep_probabilities(self, sample_bound):
+        """
+        Keep probability p of Exercise 1-2 for every vocabulary entry, computed once per sample_bound.
+        :return: [vocab_dim] (np.ndarray)
+        """
+        if self.keep_prob is None or self.keep_prob_bound != sample_bound or len(self.keep_prob) != self.vocab.num_words:
+            frequency = self.vocab.counts.astype(np.float64)
+            self.keep_prob = (frequency - sample_bound) / frequency - np.sqrt(sample_bound / frequency)
+            self.keep_prob_bound = sample_bound
+        return self.keep_prob
+
+    def train_epoch_pair(self, learning_rate, window_size, num_negative, sample_bound, final_learning_rate=None):
+        """
+        Run one epoch over self.corpus, updating weights once per (center, context) pair.
+        :param final_learning_rate: (float) : see decayed_learning_rate, applied once per sentence
+        :return: (int, float) : number of (center, context) pairs trained and their summed loss
+        """
+        num_pairs = 0
+        loss = 0.
+        for tokens, progress in sentences_with_progress(self.corpus):
+            sentence_learning_rate = self.decayed_learning_rate(learning_rate, final_learning_rate, progress)
+            line = self.subsample_indices(sample_bound, tokens)
+
+            line_pos = 0
+
+            for word_idx in line:
+
+                soft_slide = np.random.randint(window_size, size=1).item()
+                start_idx = max(line_pos - window_size + soft_slide, 0)
+                end_idx = line_pos + window_size + 1 - soft_slide
+
+                for center_idx in line[start_idx:end_idx]:
+
+                    if center_idx >= self.vocab.num_words:
+                        continue
+                    if center_idx == word_idx:
+                        continue
+                    center_idx = int(center_idx)
+
+                    targets, labels, mask = self.output_targets(np.array([word_idx]), num_negative)
+                    gradients = []
+                    for context_idx, label, valid in zip(targets[0].tolist(), labels[0].tolist(), mask[0].tolist()):
+                        if not valid:
+                            continue
+                        ff = self.forward(center_idx, context_idx, self.W, self.W_prime)
+                        gradients.append((self.backward(ff, label), center_idx, context_idx))
+
+                    self.optimize(sentence_learning_rate, gradients, self.W, self.W_prime)
+                    num_pairs += 1
+                    loss += logistic_loss([grad for grad, _, _ in gradients])
+
+                line_pos += 1
+        return num_pairs, loss
+
+    def window_pairs(self, line, window_size, offsets=None):
+        """
+        Collect every (center, context) pair of subsampled sentences with the soft sliding window, in one shot.
+        Each position draws its window shrinkage soft_slide, then a [num_tokens, 2 * window_size + 1]
+        gather of the padded tokens (each position plus every window offset) is masked to the offsets
+        within window_size - soft_slide that stay inside the sentence and hold a different word.
+        :param line: (np.ndarray or List[int]) : subsampled word indices of one sentence, or of several
+            sentences concatenated
+        :param window_size: (int) : maximum window size
+        :param offsets: (np.ndarray) : sentence offsets into line as in Corpus, or None for a single sentence
+        :return: (np.ndarray, np.ndarray) : center indices (rows of W) and context indices (rows of W_prime),
+            ordered by context position as in train_epoch_pair
+        """
+        line = np.asarray(line, dtype=np.int64)
+        if len(line) == 0:
+            return line, line
+        soft_slide = np.random.randint(window_size, size=len(line))
+        positions = np.arange(len(line))[:, None] + np.arange(2 * window_size + 1)
+        windows = np.pad(line, window_size, constant_values=-1)[positions]
+        distance = np.abs(np.arange(-window_size, window_size + 1))
+        valid = (distance <= (window_size - soft_slide)[:, None]) & (windows != line[:, None]) & (windows >= 0)
+        if offsets is not None and len(offsets) > 2:
+            sentence = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+            sentence_windows = np.pad(sentence, window_size, constant_values=-1)[positions]
+            valid &= sentence_windows == sentence[:, None]
+        return windows[valid], np.broadcast_to(line[:, None], windows.shape)[valid]
+
+    def draw_negatives(self, num_pairs, num_negative):
+        """
+        Draw negative samples for a batch of pairs from the unigram distribution in one call.
+        :param num_pairs: (int) : number of (center, context) pairs
+        :param num_negative: (int) : number of negative samples per pair
+        :return: [num_pairs, num_negative] (np.ndarray) : negative indices
+        - Negatives equal to their positive context are skipped by the caller.
+        """
+        negatives = self.sampler.sample((num_pairs, num_negative))
+        # As with the original table lookup, index 0 is replaced by a uniformly drawn word.
+        zeros = negatives == 0
+        negatives[zeros] = np.random.randint(self.vocab.num_words, size=int(zeros.sum()))
+        return negatives
+
+    def output_targets(self, contexts, num_negative):
+        """
+        Rows of W_prime that a batch of positive context words is trained against, with their labels.
+        - Negative sampling: the context itself (label 1) and num_negative drawn negatives (label 0).
+          Negatives equal to the context are masked out.
+        - Hierarchical softmax: the inner nodes on the Huffman path of the context (label 1 - code).
+        :param contexts: [batch] (np.ndarray) : positive context indices
+        :param num_negative: (int) : number of negative samples per pair, unused by hierarchical softmax
+        :return: ([batch, k] (np.ndarray), [batch, k] (np.ndarray), [batch, k] (np.ndarray)) :
+            indices of W_prime matrix, labels and a mask of the entries to train
+        """
+        if self.objective == "hs":
+            points, labels, mask = self.tree.path(contexts)
+            return points, labels.astype(self.dtype), mask
+        negatives = self.draw_negatives(len(contexts), num_negative)
+        targets = np.concatenate([contexts[:, None], negatives], axis=1)
+        labels = np.zeros(targets.shape, dtype=self.dtype)
+        labels[:, 0] = 1
+        mask = np.ones(targets.shape, dtype=bool)
+        mask[:, 1:] = negatives != contexts[:, None]
+        return targets, labels, mask
+
+    def train_batch(self, learning_rate, centers, targets, labels, mask):
+        """
+        Update W and W_prime for a whole minibatch of pairs at once.
+        :param learning_rate: (float) : learning rate
+        :param centers: [batch] (np.ndarray) : indices of W matrix
+        :param targets, labels, mask: see output_targets
+
+        Every gradient in the batch is computed from the weights as they were before the batch,
+        then the updates of rows that occur more than once are scaled down, see scatter_updates.
+        :return: (float) : summed loss of the batch
+        """
+        hidden = self.W[centers]
+        hidden_gradients, loss = self.output_step(learning_rate, hidden, targets, labels, mask)
+        scatter_updates(self.W, centers, hidden_gradients)
+        return loss
+
+    def output_step(self, learning_rate, hidden, targets, labels, mask):
+        """
+        Update the W_prime rows of a minibatch and return the updates for its hidden vectors.
+        :param learning_rate: (float) : learning rate
+        :param hidden: [batch, embedding_dim] (np.ndarray) : hidden vectors, computed from W
+        :param targets, labels, mask: see output_targets
+        :return: ([batch, embedding_dim] (np.ndarray), float) : updates to add to the hidden vectors
+            (from W_prime as it was before this step) and the summed loss
+        """
+        outputs = self.W_prime[targets]
+        forwards = np.einsum('bd,bkd->bk', hidden, outputs)
+
+        errors = self.backward_batch(forwards, labels) * mask
+        gradients = learning_rate * errors
+
+        batch_ids, slots = np.nonzero(mask)
+        scatter_updates(self.W_prime, targets[batch_ids, slots], gradients[batch_ids, slots, None] * hidden[batch_ids])
+        return np.einsum('bk,bkd->bd', gradients, outputs), logistic_loss(errors[mask])
+
+    def batches(self, corpus, window_size, num_negative, sample_bound, batch_size):
+        """
+        Subsample corpus, expand the pairs of each block of sentences and draw their output targets.
+        :return: (Iterator[(float, tuple)]) : the fraction of corpus read before each minibatch, and its
+            (centers, targets, labels, mask) of batch_size pairs (the last one may be smaller), the arguments
+            of train_batch after the learning rate
+        """
+        centers = contexts = np.empty(0, dtype=np.int64)
+        progress = np.empty(0)
+        for block, block_start, block_end in self.subsample_corpus(corpus, sample_bound).progress_blocks():
+            block_centers, block_contexts = self.window_pairs(block.tokens, window_size, block.offsets)
+            centers = np.concatenate([centers, block_centers])
+            contexts = np.concatenate([contexts, block_contexts])
+            progress = np.concatenate([progress, np.linspace(block_start, block_end, len(block_centers),
+                                                             endpoint=False)])
+
+            num_full = len(centers) - len(centers) % batch_size
+            for start in range(0, num_full, batch_size):
+                yield float(progress[start]), (centers[start:start + batch_size],) + \
+                    self.output_targets(contexts[start:start + batch_size], num_negative)
+            centers, contexts, progress = centers[num_full:], contexts[num_full:], progress[num_full:]
+
+        if len(centers):
+            yield float(progress[0]), (centers,) + self.output_targets(contexts, num_negative)
+
+    def train_epoch_batch(self, learning_rate, window_size, num_negative, sample_bound, batch_size,
+                          final_learning_rate=None):
+        """
+        Run one epoch over self.corpus, updating weights once per minibatch from batches.
+        :param final_learning_rate: (float) : see decayed_learning_rate, applied once per minibatch
+        :return: (int, float) : number of (center, context) pairs trained and their summed loss
+        """
+        num_pairs = 0
+        loss = 0.
+        for progress, batch in self.batches(self.corpus, window_size, num_negative, sample_bound, batch_size):
+            loss += self.train_batch(self.decayed_learning_rate(learning_rate, final_learning_rate, progress), *batch)
+            num_pairs += len(batch[0])
+        return num_pairs, loss
+
+    def train_epoch_pipeline(self, learning_rate, window_size, num_negative, sample_bound, batch_size,
+                             producers=1, queue_depth=16, producer_backend="thread", final_learning_rate=None):
+        """
+        Run one epoch with batches built in the background: each producer runs batches over its own shard
+        of self.corpus and puts the minibatches into a queue of at most queue_depth, while this thread
+        applies them with train_batch as they arrive.
+        With process producers every producer gets its own RNG stream seeded from the main one.
+        Thread producers share the global RNG, so their draws depend on scheduling.
+        The seconds producers spent blocked on a full queue and the updater spent waiting on an empty one
+        are kept in self.pipeline_stalls. If a producer or the updater fails, or a producer dies without
+        finishing, the other producers are stopped and the queue is drained until all of them have finished,
+        then the error is raised with the producer's traceback.
+        :param producers: (int) : number of producer threads or processes
+        :param queue_depth: (int) : maximum number of minibatches waiting in the queue
+        :param producer_backend: (str) : "thread" or "process"
+        :param final_learning_rate: (float) : see decayed_learning_rate, applied with the progress of each
+            minibatch through the shard of its producer
+        :return: (int, float) : number of (center, context) pairs trained and their summed loss
+        """
+        # Computed once here, so that thread producers do not race on the cache.
+        self.keep_probabilities(sample_bound)
+        batch_args = (window_size, num_negative, sample_bound, batch_size)
+        if producer_backend == "process":
+            batch_queue = multiprocessing.Queue(queue_depth)
+            stop = multiprocessing.Event()
+            seeds = np.random.randint(2 ** 31 - 1, size=producers)
+            workers = [multiprocessing.Process(
+                target=_pipeline_producer,
+                args=(self, i, self.corpus.shard(i, producers), int(seeds[i]), batch_queue, stop) + batch_args)
+                for i in range(producers)]
+        else:
+            batch_queue = queue.Queue(queue_depth)
+            stop = threading.Event()
+            workers = [threading.Thread(
+                target=_pipeline_producer,
+                args=(self, i, self.corpus.shard(i, producers), None, batch_queue, stop) + batch_args)
+                for i in range(producers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        num_pairs = 0
+        loss = 0.
+        producer_stall = consumer_stall = 0.
+        errors = []
+        finished = set()
+        try:
+            while len(finished) < producers:
+                wait_start = time.perf_counter()
+                message = _receive(batch_queue, workers, finished)
+                consumer_stall += time.perf_counter() - wait_start
+                if message[0] == 'batch':
+                    # After a failure the remaining batches are only drained.
+                    if not stop.is_set():
+                        progress, batch = message[1]
+                        loss += self.train_batch(
+                            self.decayed_learning_rate(learning_rate, final_learning_rate, progress), *batch)
+                        num_pairs += len(batch[0])
+                elif message[1] not in finished:
+                    _, producer_id, stall, error = message
+                    producer_stall += stall
+                    finished.add(producer_id)
+                    if error is not None:
+                        errors.append(error)
+                        stop.set()
+        finally:
+            if len(finished) < producers:
+                # The updater failed: no producer may stay blocked on a full queue.
+                stop.set()
+                while len(finished) < producers:
+                    message = _receive(batch_queue, workers, finished)
+                    if message[0] == 'done':
+                        finished.add(message[1])
+            for worker in workers:
+                worker.join()
+        if errors:
+            raise RuntimeError("Pipeline producer failed:\n{}".format(errors[0]))
+        self.pipeline_stalls = {'producer_stall': producer_stall, 'consumer_stall': consumer_stall}
+        if self.profiler is not None:
+            for (name, seconds) in self.pipeline_stalls.items():
+                self.profiler.totals[name] += seconds
+                self.profiler.calls[name] += 1
+        return num_pairs, loss
+
+    @staticmethod
+    def decayed_learning_rate(learning_rate, final_learning_rate, progress):
+        """
+        :param learning_rate: (float) : learning rate at the start of the epoch
+        :param final_learning_rate: (float) : learning rate at the end of the epoch, or None for no decay
+        :param progress: (float) : fraction of the epoch's tokens read so far
+        :return: (float) : the learning rate decayed linearly with progress, as in the original word2vec
+        """
+        if final_learning_rate is None:
+            return learning_rate
+        return learning_rate + (final_learning_rate - learning_rate) * progress
+
+    def train_epoch(self, train_mode, learning_rate, window_size, num_negative, sample_bound, batch_size,
+                    producers=1, queue_depth=16, producer_backend="thread", final_learning_rate=None):
+        if train_mode == "pipeline":
+            return self.train_epoch_pipeline(learning_rate, window_size, num_negative, sample_bound, batch_size,
+                                             producers, queue_depth, producer_backend, final_learning_rate)
+        if train_mode == "batch":
+            return self.train_epoch_batch(learning_rate, window_size, num_negative, sample_bound, batch_size,
+                                          final_learning_rate)
+        return self.train_epoch_pair(learning_rate, window_size, num_negative, sample_bound, final_learning_rate)
+
+    @contextlib.contextmanager
+    def shared_weights(self):
+        """
+        Move W and W_prime into shared memory for Hogwild workers, and copy them back on exit
+        so that the blocks can be released.
+        """
+        try:
+            from multiprocessing import shared_memory
+        except ImportError:
+            raise RuntimeError("Hogwild workers need multiprocessing.shared_memory (Python 3.8 or newer)")
+        shms, weights = [], []
+        try:
+            for matrix in (self.W, self.W_prime):
+                shm = shared_memory.SharedMemory(create=True, size=matrix.nbytes)
+                shms.append(shm)
+                weights.append(np.ndarray(matrix.shape, dtype=matrix.dtype, buffer=shm.buf))
+                weights[-1][:] = matrix
+            self.W, self.W_prime = weights
+            yield [shm.name for shm in shms]
+        finally:
+            self.W, self.W_prime = np.array(self.W), np.array(self.W_prime)
+            del weights[:]
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+    def train_epoch_hogwild(self, shm_names, workers, *epoch_args):
+        """
+        Run one epoch with lock-free asynchronous SGD (Hogwild) in several processes, as in the original
+        word2vec. W and W_prime must live in shared memory (see shared_weights). self.corpus is split into
+        one contiguous shard per worker, and every worker gets its own RNG stream seeded from the main one.
+        The random draws are reproducible for a fixed number of workers, but the interleaving of
+        unsynchronized row updates is not.
+        :param epoch_args: arguments of train_epoch
+        :return: (int, float) : number of (center, context) pairs trained by all workers and their summed loss
+        """
+        seeds = np.random.randint(2 ** 31 - 1, size=workers)
+        num_pairs = multiprocessing.Array('q', workers, lock=False)
+        losses = multiprocessing.Array('d', workers, lock=False)
+        processes = []
+        for worker_id in range(workers):
+            shard = self.corpus.shard(worker_id, workers)
+            process = multiprocessing.Process(
+                target=_hogwild_worker,
+                args=(self, shm_names, worker_id, shard, int(seeds[worker_id]), num_pairs, losses) + epoch_args)
+            process.start()
+            processes.append(process)
+        try:
+            for process in processes:
+                process.join()
+                if process.exitcode != 0:
+                    raise RuntimeError("Hogwild worker exited with code {}".format(process.exitcode))
+        finally:
+            # No worker may outlive the shared memory that shared_weights releases after an error.
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+        return sum(num_pairs), sum(losses)
+
+    def save_checkpoint(self, file_name, epoch, loss=np.nan):
+        """
+        Atomically write W, W_prime, the vocabulary, the numpy RNG state, the number of finished epochs
+        and the loss of the last one.
+        """
+        _, rng_key, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+        tmp_file_name = file_name + '.tmp'
+        with open(tmp_file_name, 'wb') as fout:
+            np.savez(fout, W=self.W, W_prime=self.W_prime, epoch=epoch, loss=loss,
+                     words=np.array(self.vocab.words), counts=self.vocab.counts,
+                     rng_key=rng_key, rng_pos=rng_pos, rng_has_gauss=rng_has_gauss,
+                     rng_cached_gaussian=rng_cached_gaussian)
+        os.replace(tmp_file_name, file_name)
+
+    def load_checkpoint(self, file_name):
+        """
+        Restore W, W_prime and the numpy RNG state written by save_checkpoint.
+        The vocabulary must already be built from the same corpus.
+        :return: (int, float) : number of finished epochs and the loss of the last one
+        """
+        checkpoint = np.load(file_name)
+        if checkpoint['words'].tolist() != self.vocab.words or \
+                not np.array_equal(checkpoint['counts'], self.vocab.counts):
+            raise ValueError("Checkpoint {} was trained on a different vocabulary".format(file_name))
+        self.W = checkpoint['W'].astype(self.dtype)
+        self.W_prime = checkpoint['W_prime'].astype(self.dtype)
+        np.random.set_state(('MT19937', checkpoint['rng_key'], int(checkpoint['rng_pos']),
+                             int(checkpoint['rng_has_gauss']), float(checkpoint['rng_cached_gaussian'])))
+        return int(checkpoint['epoch']), float(checkpoint['loss'])
+
+    def load_model(self, file_name):
+        """
+        Rebuild an empty vocabulary from a checkpoint written by save_checkpoint and restore its weights.
+        :return: (int, float) : see load_checkpoint
+        """
+        checkpoint = np.load(file_name)
+        for (word, count) in zip(checkpoint['words'].tolist(), checkpoint['counts'].tolist()):
+            self.vocab.add_word(word, count)
+            self.vocab.total_words += count
+        self.vocab.trimmed = True
+        return self.load_checkpoint(file_name)
+
+    def grow_vocabulary(self, input_file_name, min_count, max_count, count_workers=1):
+        """
+        Continue from a trained model on new sentences only: add their counts to the vocabulary,
+        append freshly initialized W/W_prime rows for new words and rebuild the noise distribution.
+        :return: (Corpus) : the new sentences
+        """
+        if self.objective == "hs":
+            raise ValueError("Online updates need the ns objective: growing the Huffman tree "
+                             "would reassign the inner-node rows of W_prime")
+        self.sentences = []
+        for file_name in input_files(input_file_name):
+            with open(file_name, 'r', encoding="utf-8") as input_file:
+                self.sentences += input_file.readlines()
+        num_new_words = self.vocab.update(self.sentences, min_count, max_count, count_workers)
+        print("Add {} new words to {} existing ones".format(num_new_words, len(self.W)))
+
+        low = -0.5 / self.embed_dim
+        high = 0.5 / self.embed_dim
+        self.W = np.concatenate([self.W, np.random.uniform(low, high, (num_new_words, self.embed_dim)).astype(self.dtype)])
+        self.W_prime = np.concatenate([self.W_prime, np.zeros((num_new_words, self.embed_dim), dtype=self.dtype)])
+        # Counts of existing words changed as well, so the keep probabilities are stale.
+        self.keep_prob = None
+        return Corpus.compile(self.sentences, self.vocab)
+
+    def load_corpus(self, input_file_name, min_count, max_count, corpus_cache_dir=None, count_workers=1):
+        """
+        Build the vocabulary and tokenize the input file into a Corpus, once per run.
+        If corpus_cache_dir is given, the token arrays and the vocabulary are saved there and
+        memory-mapped by later runs with the same input file and count bounds.
+        The words are counted in count_workers processes. A directory or glob of shard files is counted
+        file by file instead, and returned as a ShardedCorpus that is tokenized lazily every epoch;
+        it is not cached.
+        :return: (Corpus or ShardedCorpus)
+        """
+        if is_sharded(input_file_name):
+            file_names = input_files(input_file_name)
+            print("Count words of {} shards".format(len(file_names)))
+            self.vocab.init_counts(count_files(file_names, count_workers), min_count, max_count)
+            return ShardedCorpus(file_names, self.vocab)
+
+        prefix = None
+        if corpus_cache_dir:
+            os.makedirs(corpus_cache_dir, exist_ok=True)
+            prefix = Corpus.cache_prefix(corpus_cache_dir, input_file_name, min_count, max_count)
+            source = Corpus.source_stamp(input_file_name)
+            if Corpus.is_cached(prefix, input_file_name):
+                print("Load cached corpus from {}".format(prefix))
+                self.vocab.load(prefix + '.vocab.txt')
+                return Corpus.load(prefix)
 
-        print('Starting training using file ', input_file_name)
         input_file = open(input_file_name, 'r', encoding="utf-8")
 
         # Read sentences from a input file
         self.sentences = input_file.readlines()
 
         # Initialize a vocabulary with a training corpus
-        self.vocab.init_dict(self.sentences, min_count, max_count)
+        self.vocab.init_dict(self.sentences, min_count, max_count, count_workers)
+
+        corpus = Corpus.compile(self.sentences, self.vocab)
+        if prefix is not None:
+            self.vocab.save(prefix + '.vocab.txt')
+            corpus.save(prefix, source)
+        return corpus
+
+    def train(self, input_file_name, output_file_name,
+              total_epoch, learning_rate, min_count, max_count, window_size, num_negative, sample_bound,
+              debug, train_mode="pair", batch_size=256, workers=1, corpus_cache_dir=None, output_format="text",
+              visualize_top_k=500, visualize_pca_dim=50,
+              checkpoint_dir=None, checkpoint_epochs=0, checkpoint_minutes=0, resume=False,
+              lr_decay=False, min_loss_improvement=0., callback=print_epoch_stats, profile_json=None,
+              update_from=None, producers=1, queue_depth=16, producer_backend="thread", count_workers=1):
+        """
+        :param workers: (int) : number of Hogwild training processes, see train_epoch_hogwild
+        :param count_workers: (int) : number of processes counting the vocabulary, independent of workers
+        :param producers, queue_depth, producer_backend: background batch producers of the "pipeline"
+            train_mode, see train_epoch_pipeline
+        :param update_from: (str) : checkpoint of a trained model to continue from. Only the sentences of
+            input_file_name are trained on for total_epoch epochs, see grow_vocabulary.
+        """
+        np.random.seed(6)
 
-        # Also construct the unigram language model
-        print("\nInit Unigram Table")
-        self.init_unigram_table()
+        if debug:
+            pdb.set_trace()
+
+        print('Starting training using file ', input_file_name)
+        if update_from:
+            print("Update model from {}".format(update_from))
+            self.load_model(update_from)
+            self.corpus = self.grow_vocabulary(input_file_name, min_count, max_count, count_workers)
+        else:
+            self.corpus = self.load_corpus(input_file_name, min_count, max_count, corpus_cache_dir, count_workers)
+
+        if self.objective == "hs":
+            print("\nInit Huffman Tree")
+            self.init_huffman_tree()
+        else:
+            # Also construct the unigram language model
+            print("\nInit Unigram Table")
+            self.init_unigram_table()
 
         # Initialize weights
-        low = -0.5 / self.embed_dim
-        high = 0.5 / self.embed_dim
-        self.W = np.random.uniform(low, high, (self.vocab.num_words, self.embed_dim))
-        self.W_prime = np.zeros((self.vocab.num_words, self.embed_dim))
+        if not update_from:
+            low = -0.5 / self.embed_dim
+            high = 0.5 / self.embed_dim
+            self.W = np.random.uniform(low, high, (self.vocab.num_words, self.embed_dim)).astype(self.dtype)
+            self.W_prime = np.zeros((self.vocab.num_words, self.embed_dim), dtype=self.dtype)
 
-        print("\nRunning...")
-        for _ in trange(total_epoch):
-            for sentence in self.sentences:
-                sentence = preprocess(sentence)
-                line = self.subsampling(sample_bound, sentence)
+        start_epoch = 0
+        loss = np.nan
+        checkpoint_file_name = None
+        if checkpoint_dir:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            checkpoint_file_name = os.path.join(checkpoint_dir, 'checkpoint.npz')
+            if resume and os.path.isfile(checkpoint_file_name):
+                start_epoch, loss = self.load_checkpoint(checkpoint_file_name)
+                print("\nResume from {} at epoch {}".format(checkpoint_file_name, start_epoch))
 
-                line_pos = 0
+        print("\nRunning...")
+        num_pairs = 0
+        start_time = last_checkpoint_time = time.time()
+        corpus = self.corpus
+        with self.shared_weights() if workers > 1 else contextlib.nullcontext() as shm_names:
+            for epoch in trange(start_epoch, total_epoch):
+                if isinstance(corpus, ShardedCorpus):
+                    # Shuffled from the sorted order every epoch, so a resumed run sees the same orders.
+                    self.corpus = corpus.shuffled()
+                epoch_learning_rate = learning_rate
+                final_learning_rate = None
+                if lr_decay:
+                    # Decayed within the epoch too, by the fraction of its tokens read, see decayed_learning_rate.
+                    epoch_learning_rate = learning_rate * max(1. - epoch / total_epoch, 1e-4)
+                    final_learning_rate = learning_rate * max(1. - (epoch + 1) / total_epoch, 1e-4)
+                epoch_args = (train_mode, epoch_learning_rate, window_size, num_negative, sample_bound, batch_size,
+                              producers, queue_depth, producer_backend, final_learning_rate)
 
-                for word_idx in line:
+                epoch_start_time = time.time()
+                if workers > 1:
+                    epoch_pairs, epoch_loss = self.train_epoch_hogwild(shm_names, workers, *epoch_args)
+                else:
+                    epoch_pairs, epoch_loss = self.train_epoch(*epoch_args)
+                epoch_time = time.time() - epoch_start_time
+                num_pairs += epoch_pairs
+                if self.profiler is not None:
+                    self.profiler.end_epoch(epoch + 1, epoch_pairs, epoch_time)
 
-                    soft_slide = np.random.randint(window_size, size=1).item()
-                    start_idx = max(line_pos - window_size + soft_slide, 0)
-                    end_idx = line_pos + window_size + 1 - soft_slide
+                previous_loss, loss = loss, epoch_loss / max(epoch_pairs, 1)
+                if not (np.isfinite(epoch_loss) and np.isfinite(self.W).all() and np.isfinite(self.W_prime).all()):
+                    raise RuntimeError("Training diverged in epoch {} (loss {}), lower the learning rate "
+                                       "or the batch size".format(epoch + 1, loss))
+                improvement = (previous_loss - loss) / previous_loss if previous_loss > 0 else np.nan
+                if callback is not None:
+                    stats = {'epoch': epoch + 1, 'num_pairs': epoch_pairs, 'loss': loss,
+                             'improvement': improvement, 'learning_rate': epoch_learning_rate,
+                             'pairs_per_sec': epoch_pairs / max(epoch_time, 1e-12)}
+                    if train_mode == "pipeline" and self.pipeline_stalls is not None:
+                        stats.update(self.pipeline_stalls)
+                    callback(stats)
 
-                    for center_idx in line[start_idx:end_idx]:
+                if checkpoint_file_name is not None and (
+                        (checkpoint_epochs > 0 and (epoch + 1) % checkpoint_epochs == 0) or
+                        (checkpoint_minutes > 0 and time.time() - last_checkpoint_time >= 60 * checkpoint_minutes)):
+                    self.save_checkpoint(checkpoint_file_name, epoch + 1, loss)
+                    last_checkpoint_time = time.time()
 
-                        if self.vocab.index2count.get(center_idx) is None:
-                            continue
-                        if center_idx == word_idx:
-                            continue
-                        center_idx = int(center_idx)
-
-                        gradients = []
-                        for neg_sample in range(num_negative + 1):
-                            if neg_sample == 0:
-                                context_idx = word_idx
-                                label = 1
-                            else:
-                                rand = np.random.randint(int(len(self.table)), size=1).item()
-                                context_idx = int(self.table[rand])
-                                if context_idx == 0:
-                                    context_idx = np.random.randint(self.vocab.num_words, size=1).item()
-                                if context_idx == word_idx:
-                                    continue
-                                label = 0
-                            ff = self.forward(center_idx, context_idx, self.W, self.W_prime)
-                            gradients.append((self.backward(ff, label), center_idx, context_idx))
-
-                        self.optimize(learning_rate, gradients, self.W, self.W_prime)
-
-                    line_pos += 1
+                if min_loss_improvement > 0 and improvement < min_loss_improvement:
+                    print("\nStop at epoch {}: relative loss improvement {:.2e} < {:.2e}".format(
+                        epoch + 1, improvement, min_loss_improvement))
+                    break
+        elapsed = time.time() - start_time
+        print("\nTrained {} pairs in {:.2f}s ({:.0f} pairs/sec, mode: {}, workers: {})".format(
+            num_pairs, elapsed, num_pairs / max(elapsed, 1e-12), train_mode, workers))
 
         print("\nSave embedding at {}".format(output_file_name))
-        self.save_embedding(output_file_name)
+        self.save_embedding(output_file_name, output_format)
+        if self.profiler is not None:
+            print("\n" + self.profiler.summary())
+            if profile_json:
+                self.profiler.dump(profile_json)
+        if visualize_top_k > 0:
+            self.visualize(output_file_name, visualize_top_k, visualize_pca_dim)
+
+
+class CBOW(SkipGram):
+
+    """
+    Continuous bag-of-words with negative sampling. The context rows of W inside a soft sliding
+    window are averaged into a single hidden vector, which predicts the target word in W_prime,
+    so there is one update per target word instead of one per (center, context) pair.
+    Vocabulary, corpus, negative sampler, checkpoints and save_embedding are shared with SkipGram.
+    In the statistics reported by train, a "pair" is one (target, context window) update.
+    """
+
+    def window_contexts(self, line, window_size):
+        """
+        Collect the context window of every word of a subsampled sentence with the soft sliding window.
+        :param line: (List[int]) : subsampled word indices of a sentence
+        :param window_size: (int) : maximum window size
+        :return: (List[int], List[List[int]]) : target indices (rows of W_prime) and their context indices
+            (rows of W), leaving out the target position itself and windows without any context
+        """
+        targets, contexts = [], []
+        for line_pos, word_idx in enumerate(line):
+            soft_slide = np.random.randint(window_size)
+            start_idx = max(line_pos - window_size + soft_slide, 0)
+            end_idx = line_pos + window_size + 1 - soft_slide
+            context = line[start_idx:line_pos] + line[line_pos + 1:end_idx]
+            if context:
+                targets.append(word_idx)
+                contexts.append(context)
+        return targets, contexts
+
+    def train_epoch_pair(self, learning_rate, window_size, num_negative, sample_bound, final_learning_rate=None):
+        """
+        Run one epoch over self.corpus, updating weights once per target word.
+        :param final_learning_rate: (float) : see decayed_learning_rate, applied once per sentence
+        :return: (int, float) : number of (target, context window) updates and their summed loss
+        """
+        num_windows = 0
+        loss = 0.
+        for tokens, progress in sentences_with_progress(self.corpus):
+            sentence_learning_rate = self.decayed_learning_rate(learning_rate, final_learning_rate, progress)
+            line = self.subsample_indices(sample_bound, tokens)
+            for word_idx, context in zip(*self.window_contexts(line, window_size)):
+                hidden = self.W[context].mean(axis=0)
+                targets, labels, mask = self.output_targets(np.array([word_idx]), num_negative)
+                gradients = []
+                for target_idx, label, valid in zip(targets[0].tolist(), labels[0].tolist(), mask[0].tolist()):
+                    if not valid:
+                        continue
+                    gradients.append((self.backward(hidden.dot(self.W_prime[target_idx]), label), target_idx))
+
+                self.optimize_window(sentence_learning_rate, gradients, context, hidden)
+                num_windows += 1
+                loss += logistic_loss([grad for grad, _ in gradients])
+        return num_windows, loss
+
+    def optimize_window(self, learning_rate, gradients, context, hidden):
+        """
+        SGD step of one context window.
+        :param learning_rate: (float) : learning rate
+        :param gradients: (list) : list of (gradient (float), W_prime index (int)) pairs
+        :param context: (List[int]) : context indices of W matrix
+        :param hidden: [embedding_dim] (np.ndarray) : mean of the context rows of W
+        """
+        hidden_gradient = np.zeros(self.embed_dim, dtype=self.dtype)
+        for grad, target_idx in gradients:
+            hidden_gradient += learning_rate * grad * self.W_prime[target_idx]
+            self.W_prime[target_idx] += learning_rate * grad * hidden
+
+        # A word may appear more than once in the window.
+        np.add.at(self.W, context, hidden_gradient)
+
+    def train_batch(self, learning_rate, contexts, targets, labels, mask):
+        """
+        Update W and W_prime for a whole minibatch of context windows at once.
+        :param learning_rate: (float) : learning rate
+        :param contexts: [batch, max_context] (np.ndarray) : context indices of W matrix, padded with -1
+        :param targets, labels, mask: see output_targets, for the target words of the windows
+        :return: (float) : summed loss of the batch
+        """
+        in_window = contexts >= 0
+        rows = np.where(in_window, contexts, 0)
+        counts = in_window.sum(axis=1)
+        hidden = (self.W[rows] * in_window[:, :, None]).sum(axis=1) / counts[:, None].astype(self.dtype)
+        hidden_gradients, loss = self.output_step(learning_rate, hidden, targets, labels, mask)
+        scatter_updates(self.W, rows[in_window], np.repeat(hidden_gradients, counts, axis=0))
+        return loss
+
+    def batches(self, corpus, window_size, num_negative, sample_bound, batch_size):
+        """
+        Subsample corpus and collect its context windows into minibatches of at least batch_size.
+        :return: (Iterator[(float, tuple)]) : the fraction of corpus read before each minibatch, and its
+            (contexts, targets, labels, mask), the arguments of train_batch after the learning rate
+        """
+        words, contexts = [], []
+        batch_progress = 0.
+        for tokens, progress in sentences_with_progress(self.subsample_corpus(corpus, sample_bound)):
+            if not words:
+                batch_progress = progress
+            line_words, line_contexts = self.window_contexts(tokens.tolist(), window_size)
+            words += line_words
+            contexts += line_contexts
+
+            if len(words) >= batch_size:
+                yield batch_progress, self._pad_windows(num_negative, window_size, words, contexts)
+                words, contexts = [], []
+
+        if words:
+            yield batch_progress, self._pad_windows(num_negative, window_size, words, contexts)
+
+    def _pad_windows(self, num_negative, window_size, words, contexts):
+        padded = np.full((len(contexts), 2 * window_size), -1, dtype=np.int64)
+        for row, context in enumerate(contexts):
+            padded[row, :len(context)] = context
+        return (padded,) + self.output_targets(np.asarray(words, dtype=np.int64), num_negative)
+
+
+MODELS = {"skipgram": SkipGram, "cbow": CBOW}
 
 
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Parser for SkipGram Negative Sampling')
+    parser.add_argument("--model", type=str, default="skipgram", choices=sorted(MODELS),
+                        help="Train skip-gram, or CBOW on the same infrastructure")
     parser.add_argument("--embedding-dim", type=int, default=100)
-    parser.add_argument("--input-file-name", type=str, default="../data/korea.txt")
+    parser.add_argument("--input-file-name", type=str, default="../data/korea.txt",
+                        help="Corpus file, or a directory or quoted glob of corpus shards")
     parser.add_argument("--output-file-name", type=str, default="./embedding_results.txt")
+    parser.add_argument("--output-format", type=str, default="text", choices=["text", "binary", "npy"],
+                        help="text, word2vec binary, or a float32 .npy matrix with a sidecar vocabulary file")
+    parser.add_argument("--visualize-top-k", type=int, default=500,
+                        help="Plot the t-SNE projection of this many most frequent words in the background (0 to skip)")
+    parser.add_argument("--visualize-pca-dim", type=int, default=50, help="PCA dimension before t-SNE (0 to skip)")
     parser.add_argument("--total-epoch", type=int, default=200, help="Number of epochs to train")
     parser.add_argument("--learning-rate", type=float, default=0.025)
     parser.add_argument("--min-count", type=int, default=7, help="Take words that appear more than min_count")
@@ -330,13 +1846,54 @@ if __name__ == '__main__':
     parser.add_argument("--num-negative", type=int, default=15, help="Number of negative samples")
     parser.add_argument("--sample-bound", type=float, default=1e-5, help="Sampling bound for subsampling")
     parser.add_argument("--debug", type=bool, default=False)
-    args = parser.parse_args(args=[])
+    parser.add_argument("--train-mode", type=str, default="pair", choices=["pair", "batch", "pipeline"],
+                        help="Update weights once per pair, or once per minibatch of pairs built inline or by "
+                             "background producers")
+    parser.add_argument("--producers", type=int, default=1, help="Number of batch producers in pipeline mode")
+    parser.add_argument("--queue-depth", type=int, default=16,
+                        help="Maximum number of minibatches waiting for the updater in pipeline mode")
+    parser.add_argument("--producer-backend", type=str, default="thread", choices=["thread", "process"],
+                        help="Run pipeline producers as threads or as processes")
+    parser.add_argument("--objective", type=str, default="ns", choices=OBJECTIVES,
+                        help="Negative sampling (ns) or hierarchical softmax (hs)")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float64"],
+                        help="Floating point type of the weight matrices and their updates")
+    parser.add_argument("--sigmoid-table-size", type=int, default=1000,
+                        help="Entries of the precomputed sigmoid over [-6, 6] (0 to compute it exactly)")
+    parser.add_argument("--negative-sampler", type=str, default="alias", choices=sorted(NEGATIVE_SAMPLERS),
+                        help="Sampler for the unigram noise distribution")
+    parser.add_argument("--corpus-cache-dir", type=str, default=None,
+                        help="Directory to cache the tokenized corpus in, memory-mapped by later runs")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes for Hogwild training")
+    parser.add_argument("--count-workers", type=int, default=1,
+                        help="Number of processes for counting the vocabulary (of the shard files or sentence chunks)")
+    parser.add_argument("--checkpoint-dir", type=str, default=None, help="Directory to write checkpoint.npz to")
+    parser.add_argument("--checkpoint-epochs", type=int, default=0, help="Write a checkpoint every N epochs (0 to skip)")
+    parser.add_argument("--checkpoint-minutes", type=float, default=0,
+                        help="Write a checkpoint when N minutes have passed since the last one (0 to skip)")
+    parser.add_argument("--resume", action="store_true", help="Continue from the checkpoint in --checkpoint-dir")
+    parser.add_argument("--lr-decay", action="store_true",
+                        help="Decay the learning rate linearly towards 0 over the tokens of total_epoch epochs")
+    parser.add_argument("--min-loss-improvement", type=float, default=0.,
+                        help="Stop when the relative improvement of the epoch loss falls below this (0 to never stop)")
+    parser.add_argument("--profile", action="store_true", help="Print time spent per training phase")
+    parser.add_argument("--profile-json", type=str, default=None, help="Also dump the profile to this JSON file")
+    parser.add_argument("--update-from", type=str, default=None,
+                        help="Checkpoint to continue from, training only on the new sentences of --input-file-name")
+    parser.add_argument("--batch-size", type=int, default=256,
+                        help="Number of pairs per minibatch in batch mode")
+    args = parser.parse_args()
 
-    _download_dataset(args.input_file_name)
+    if not is_sharded(args.input_file_name):
+        _download_dataset(args.input_file_name)
     os.makedirs(os.path.dirname(args.output_file_name), exist_ok=True)
 
     voc = Vocabulary()
-    skip = SkipGram(voc, args.embedding_dim)
+    skip = MODELS[args.model](voc, args.embedding_dim, negative_sampler=NEGATIVE_SAMPLERS[args.negative_sampler],
+                              objective=args.objective, dtype=args.dtype,
+                              sigmoid_table_size=args.sigmoid_table_size)
+    if args.profile or args.profile_json:
+        skip.enable_profiling()
     skip.train(
         input_file_name=args.input_file_name,
         output_file_name=args.output_file_name,
@@ -348,4 +1905,23 @@ if __name__ == '__main__':
         num_negative=args.num_negative,
         sample_bound=args.sample_bound,
         debug=args.debug,
+        train_mode=args.train_mode,
+        batch_size=args.batch_size,
+        workers=args.workers,
+        count_workers=args.count_workers,
+        corpus_cache_dir=args.corpus_cache_dir,
+        output_format=args.output_format,
+        visualize_top_k=args.visualize_top_k,
+        visualize_pca_dim=args.visualize_pca_dim,
+        checkpoint_dir=args.checkpoint_dir,
+        checkpoint_epochs=args.checkpoint_epochs,
+        checkpoint_minutes=args.checkpoint_minutes,
+        resume=args.resume,
+        lr_decay=args.lr_decay,
+        min_loss_improvement=args.min_loss_improvement,
+        profile_json=args.profile_json,
+        update_from=args.update_from,
+        producers=args.producers,
+        queue_depth=args.queue_depth,
+        producer_backend=args.producer_backend,
     )